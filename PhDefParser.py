@@ -22,15 +22,42 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import codecs
+import hashlib
+import os
+import pickle
 import re
 import sys
-from wordgen import textify
+from concurrent.futures import ThreadPoolExecutor
+from wordgen import SoundSystem, RuleError, textify, iter_text, cooperate
+from filters import METACHARS
 
 
-class UnknownOption(Exception): pass
+class ParseError(Exception):
+    def __init__(self, msg, fname=None, lineno=None, col=None, text=None):
+        """An error in a definition file: msg, and where it was found
+        (line and column counting from 1) if known."""
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.fname = fname
+        self.lineno = lineno
+        self.col = col
+        self.text = text
+
+    def __str__(self):
+        if self.lineno is None:
+            return self.msg
+        where = "%s:%d:%d" % (self.fname, self.lineno, self.col or 1)
+        s = "%s: %s" % (where, self.msg)
+        if self.text is not None:
+            s += "\n    %s" % self.text.rstrip()
+        return s
+
+class UnknownOption(ParseError): pass
+
 
-class ParseError(Exception): pass
+# Characters that would make a macro name mean something more than
+# itself in the regular expression expand_macros() builds from it.
+MACRO_METACHARS = set('$.^*+?{}[]\\|()')
 
 
 class PhonologyDefinition(object):
@@ -41,45 +68,82 @@ class PhonologyDefinition(object):
         self.options = []
         self.features = []
         self.macros = {}
+        self.macro_re = None     # see expand_macros()
+        self.macro_values = {}
         # For sanity checking at the end
         self.letters = []
         self.ph_classes = []   # phoneme classes
+        self.rule_lines = {}   # word shape -> (line no., line, start)
         self.parse()
         self.sanity_check()
 
     def parse(self):
-        with codecs.open(self.fname, encoding='utf-8') as f:
-            # The loop over the file is handled this way to let me
-            # pass in the file handle to a subparser.
-            line = f.readline()
-            while line != '':
-                line = re.sub(r'#.*', '', line)   # comments
-                line = line.strip()
-                if line == '': 
-                    line = f.readline()
+        # One pass over the lines, dispatching on the directive before
+        # the first colon.  Lines are split exactly as codecs' readline
+        # splits them, which the old line-at-a-time parser used.
+        dispatch = {
+            'with': self.parse_option,
+            'random-rate': self.parse_random_rate,
+            'filter': self.parse_filter,
+            'reject': self.parse_reject,
+            'words': self.parse_words,
+            'letters': self.parse_letters,
+        }
+        with open(self.fname, encoding='utf-8', newline='') as f:
+            self.lines = f.read().splitlines(True)
+        self.lineno = 0
+        try:
+            while self.lineno < len(self.lines):
+                line = self.next_line()
+                if line == '':
                     continue
-                if re.match(r'with:', line):
-                    self.parse_option(line[5:].strip())
-                elif re.match(r'random-rate:', line):
-                    self.parse_random_rate(line[12:].strip())
-                elif re.match(r'filter:', line):
-                    self.parse_filter(line[7:].strip())
-                elif re.match(r'reject:', line):
-                    self.parse_reject(line[7:].strip())
-                elif re.match(r'words:', line):
-                    self.parse_words(line[6:].strip())
-                elif re.match(r'letters:', line):
-                    self.parse_letters(line[8:].strip())
+                colon = line.find(':')
+                if colon >= 0 and line[:colon] in dispatch:
+                    dispatch[line[:colon]](line[colon + 1:].strip())
                 elif line[0] == '%':
-                    self.parse_clusterfield(line, f)
+                    self.parse_clusterfield(line)
                 elif '=' in line:
                     self.parse_class(line)
                 else:
-                    raise ParseError(line)
-                line = f.readline()
-        # A non-fatal bit of sanity checking and warning.
-        if (self.soundsys.use_assim or self.soundsys.use_coronal_metathesis) and self.soundsys.sorter is None:
-            sys.stderr.write("Without 'letters:' cannot apply assimilations or coronal metathesis.\n\n")
+                    raise self.error("Not a definition, directive or "
+                                     "cluster field", line)
+        finally:
+            del self.lines
+        # All the classes are known now, so the word shapes can be
+        # compiled (and any errors in them reported where they are).
+        try:
+            self.soundsys.compile()
+        except RuleError as e:
+            (lineno, raw, start) = self.rule_lines[e.rule]
+            raise ParseError(str(e), self.fname, lineno, start + 1, raw)
+        finally:
+            self.rule_lines = {}
+
+    def next_line(self):
+        """Step to the next line, returning it with any comment and
+        surrounding white space removed."""
+        self.raw = self.lines[self.lineno]
+        self.lineno += 1
+        comment = self.raw.find('#')
+        if comment >= 0:
+            return self.raw[:comment].strip()
+        return self.raw.strip()
+
+    def error(self, msg, near=None, cls=ParseError, start=0):
+        """A ParseError for the current line, pointing at the first
+        place near appears in it from start on."""
+        col = self.raw.find(near, start) + 1 if near else 0
+        if col <= 0:
+            col = len(self.raw) - len(self.raw.lstrip()) + 1
+        return cls(msg, self.fname, self.lineno, col, self.raw)
+
+    def find_item(self, items, i, start=0):
+        """Where items[i] is in the current line, taking the items
+        (the line, or the part of it after start, split on white
+        space) in order, so a repeated item is found in its place."""
+        for item in items[:i]:
+            start = self.raw.find(item, start) + len(item)
+        return start
 
 # add option to remove: ji, wu, bw, dl, etc. forbid onset
 # clusters from the same place 
@@ -96,7 +160,8 @@ class PhonologyDefinition(object):
             elif option == 'coronal-metathesis':
                 self.soundsys.with_coronal_metathesis()
             else:
-                raise UnknownOption(option)    
+                raise self.error("Unknown option: %s" % option, option,
+                                 UnknownOption)
 
     def add_filter(self, pre, post):
         pre = pre.strip()
@@ -113,49 +178,125 @@ class PhonologyDefinition(object):
             if filt == '': continue
 
             # Now we can parse the filter.
-            (pre, post) = filt.split(">")
-            self.add_filter(pre, post)
+            parts = filt.split(">")
+            if len(parts) != 2:
+                raise self.error("A filter needs exactly one '>': %s" % filt,
+                                 filt)
+            self.check_pattern(parts[0].strip(), filt)
+            self.add_filter(*parts)
 
     def parse_reject(self, line):
         for filt in line.split():
+            self.check_pattern(filt, filt)
             self.soundsys.add_filter(filt, 'REJECT')
 
+    def check_pattern(self, pat, near):
+        # Filters are compiled much later; catch mistakes while we
+        # still know where they are.
+        if not set(pat) & METACHARS:
+            return
+        try:
+            re.compile(pat)
+        except re.error as e:
+            raise self.error("Bad pattern '%s': %s" % (pat, e), near)
+
     def parse_letters(self, line):
         self.letters = line.split()
         self.soundsys.add_sort_order(line)
 
     def parse_words(self, line):
-        line = self.expand_macros(line)
-        for (n, word) in enumerate(line.split()):
-            # Crude Zipf distribution for word selection.
-            self.soundsys.add_rule(word, 10.0 / ((n + 1) ** .9))
+        # Macros are expanded word by word, to remember where each
+        # word shape came from.
+        n = 0
+        start = 0
+        for item in line.split():
+            start = self.raw.find(item, start)
+            for word in self.expand_macros(item).split():
+                # Crude Zipf distribution for word selection.
+                self.soundsys.add_rule(word, 10.0 / ((n + 1) ** .9))
+                self.rule_lines[word] = (self.lineno, self.raw, start)
+                n += 1
+            start += len(item)
 
     def expand_macros(self, word):
+        # The meaning is re.sub() with each macro in turn.  When no
+        # macro name is a prefix of another and the values are plain
+        # text without a '$', every '$' in the word is replaced
+        # independently, and one pass with all the names at once does
+        # the same, provided it leaves no '$' behind.
+        if self.macro_re is None:
+            self.macro_re = self.compile_macros()
+        if self.macro_re:
+            values = self.macro_values
+            expanded = self.macro_re.sub(lambda m: values[m.group()], word)
+            if '$' not in expanded:
+                return expanded
         for (macro, value) in list(self.macros.items()):
             word = re.sub(macro, value, word)
         return word
 
+    def compile_macros(self):
+        """The single regular expression for expand_macros(), or False
+        if the macros don't allow one."""
+        names = [macro[1:] for macro in self.macros]   # drop the \\
+        values = list(self.macros.values())
+        for name in names:
+            if set(name[1:]) & MACRO_METACHARS:
+                return False
+        for value in values:
+            if '$' in value or '\\' in value:
+                return False
+        for a in names:
+            for b in names:
+                if a != b and b.startswith(a):
+                    return False
+        if not names:
+            return False
+        self.macro_values = dict(zip(names, values))
+        return re.compile("|".join([re.escape(name) for name in names]))
+
     def parse_class(self, line):
-        (sclass, values) = line.split("=")
+        parts = line.split("=")
+        if len(parts) != 2:
+            raise self.error("A class definition needs exactly one '='",
+                             "=" if len(parts) < 2 else None)
+        (sclass, values) = parts
         sclass = sclass.strip()
         values = values.strip()
+        if sclass == '':
+            raise self.error("Missing class name before '='")
         if sclass[0] == '$':
             self.macros["\\" + sclass] = values
+            self.macro_re = None
         else:
             self.ph_classes += values.split()
-            self.soundsys.add_ph_unit(sclass, values)
+            try:
+                self.soundsys.add_ph_unit(sclass, values)
+            except (RuleError, ValueError) as e:
+                # Most likely some phoneme has no weight, or a weight
+                # that isn't a number.
+                items = values.split()
+                for (i, item) in enumerate(items):
+                    try:
+                        float(item.partition(':')[2])
+                    except ValueError:
+                        start = self.find_item(items, i,
+                                               self.raw.find('=') + 1)
+                        raise self.error("Not a phoneme and weight (as in "
+                                         "'a:7'): %s" % item, item,
+                                         start=start)
+                raise self.error("Bad class: %s" % e, values)
 
-    def parse_clusterfield(self, line, fh):
+    def parse_clusterfield(self, line):
         c2list = line.split()[1:]  # ignore leading %
         # Width of all rows must be 'n'.
         n = len(c2list)
-        line = fh.readline()
-        while line not in ('', '\n'):
-            # filter comments
-            line = re.sub(r'#.*', '', line)   # comments
-            line = line.strip()
+        # The field ends at the end of the file or at a line with
+        # nothing at all on it, not even spaces or a comment.
+        while (self.lineno < len(self.lines) and
+               self.lines[self.lineno] != '\n'):
+            line = self.next_line()
             if line == '':
-                line = fh.readline()
                 continue
             row = line.split()
             c1 = row[0]
@@ -169,15 +310,23 @@ class PhonologyDefinition(object):
                     else:
                         self.add_filter(c1 + c2list[i], result)
             elif len(row) > n:
-                raise ParseError("Cluster field row too long: " + line)
+                items = line.split()
+                raise self.error("Cluster field row too long", row[n],
+                                 start=self.find_item(items, n + 1))
             else:
-                raise ParseError("Cluster field row too short: " + line)
-            line = fh.readline()
+                raise self.error("Cluster field row too short", c1)
 
     def parse_random_rate(self, line):
-        self.soundsys.randpercent = int(line)
+        try:
+            self.soundsys.randpercent = int(line)
+        except ValueError:
+            raise self.error("random-rate needs a whole number, not '%s'"
+                             % line, line)
 
     def sanity_check(self):
+        # A non-fatal bit of sanity checking and warning.
+        if (self.soundsys.use_assim or self.soundsys.use_coronal_metathesis) and self.soundsys.sorter is None:
+            sys.stderr.write("Without 'letters:' cannot apply assimilations or coronal metathesis.\n\n")
         # Can't do sanity checking if the letters: directive isn't used.
         if len(self.letters) == 0: return
         letters = set(self.letters)
@@ -188,13 +337,111 @@ class PhonologyDefinition(object):
             sys.stderr.write(msg)
             sys.stderr.write("** Strange word shapes are likely to result.\n")
 
-    def generate(self, n=1, unsorted=False):
-        return self.soundsys.generate(n, unsorted)
+    def generate(self, n=1, unsorted=False, workers=1, seed=None,
+                 partial=False):
+        return self.soundsys.generate(n, unsorted, workers, seed, partial)
+
+    def generate_all(self, n=None, unsorted=False):
+        return self.soundsys.generate_all(n, unsorted)
+
+    def iter_words(self, n=None, unique=True, **kwargs):
+        return self.soundsys.iter_words(n, unique, **kwargs)
 
     def paragraph(self, sentences):
         return textify(self.soundsys, sentences)
+
+    # The same for asyncio programs; see SoundSystem.aiter_words().
+
+    def aiter_words(self, n=None, unique=True, **kwargs):
+        return self.soundsys.aiter_words(n, unique, **kwargs)
+
+    async def agenerate(self, n=1, unsorted=False, seed=None, partial=False):
+        return await self.soundsys.agenerate(n, unsorted, seed, partial)
+
+    async def aparagraph(self, sentences):
+        lines = cooperate(iter_text(self.soundsys, sentences))
+        return "\n".join([line async for line in lines])
     
 
+# Compiled phonologies.  A parsed PhonologyDefinition, with its rules
+# and filters already compiled, is pickled into a cache directory
+# under a hash of everything that went into making it but the seed:
+# the contents of the .def file, the settings below, and the Lexifer
+# source itself (so an upgrade never loads a stale layout).
+
+def default_cache_dir():
+    path = os.environ.get('LEXIFER_CACHE_DIR')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'lexifer')
+
+def cache_key(fname, unknown_letters):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        h.update(f.read())
+    h.update(repr(unknown_letters).encode('utf-8'))
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in sorted(os.listdir(here)):
+        if module.endswith('.py'):
+            st = os.stat(os.path.join(here, module))
+            h.update(("%s:%d:%d" % (module, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+    return h.hexdigest()
+
+def load_definition(fname, seed=None, unknown_letters='error', cache_dir=None):
+    """Same as PhonologyDefinition(SoundSystem(seed), fname), with
+    unknown_letters set on the sound system, but reusing a compiled
+    copy from an earlier run when there is one."""
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    path = os.path.join(cache_dir, cache_key(fname, unknown_letters)
+                        + '.pickle')
+    try:
+        with open(path, 'rb') as f:
+            pd = pickle.load(f)
+    except Exception:
+        # Missing, unreadable or damaged: just parse it again.
+        pd = None
+    if pd is not None:
+        # One copy serves every seed: the only random numbers parsing
+        # uses are the natural weights of the phoneme classes, and
+        # those are drawn again from this run's seed.
+        pd.soundsys.reweight(seed)
+        pd.sanity_check()
+        return pd
+    soundsys = SoundSystem(seed)
+    soundsys.unknown_letters = unknown_letters
+    pd = PhonologyDefinition(soundsys, fname)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(pd, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return pd
+
+
+def generate_many(fnames, n=10, seed=None, unsorted=False, partial=False,
+                  unknown_letters='error', threads=None):
+    """generate() for many definition files at once, on a pool of
+    threads.  Each file gets a sound system of its own, feature
+    database and all, so they can't interfere: with a seed, every
+    file's words are just what a run on that file alone would give.
+    Returns a dict of file name -> words.  An error in any file is
+    raised here."""
+    def one(fname):
+        soundsys = SoundSystem(seed)
+        soundsys.unknown_letters = unknown_letters
+        pd = PhonologyDefinition(soundsys, fname)
+        return pd.generate(n, unsorted, partial=partial)
+    with ThreadPoolExecutor(threads) as pool:
+        return dict(zip(fnames, pool.map(one, fnames)))
+
+
 if __name__ == '__main__':
     from wordgen import SoundSystem, textify
     
@@ -29,7 +29,31 @@ horribly to get the answers I want.
 """
 
 import sqlite3 as sql
-global phdb
+import threading
+
+NOTATIONS = ('ipa', 'digraph')
+
+# A FeatureDB works out the answer to every question the assimilation
+# functions can ask about the phonemes in DATA once, and keeps them in
+# tables.  Only pairs that actually change are stored; everything else
+# is left alone, which is also what the SQL queries say about phonemes
+# missing from the database.  The tables for each notation are made
+# the first time they're asked for and then shared, read only, by
+# every FeatureDB using that notation.
+TABLES = {}
+tables_lock = threading.Lock()
+
+# The module-level functions below work on a default FeatureDB, set
+# up by initialize().  Its tables are also kept here under their old
+# names.
+default = None
+phdb = None
+assim_table = {}
+metathesis_table = {}
+known = set()
+# If true, pairs involving phonemes outside DATA are looked up with
+# SQL (and remembered) instead of being assumed to stay as they are.
+sql_fallback = False
 
 
 DATA = [# Bilabial, labio-dental
@@ -81,10 +105,15 @@ DATA = [# Bilabial, labio-dental
   ('ɴ', 'nq', 'voiced', 'uvular', 'nasal')]
 
 
-def initialize(notation="ipa"):
-    global phdb
-    phdb = sql.connect(':memory:')
-    c = phdb.cursor()
+def connect(notation):
+    """A fresh in-memory database of the phonemes in a notation (empty
+    if notation is None)."""
+    if notation is not None and notation not in NOTATIONS:
+        raise ValueError("Unknown notation: %s" % notation)
+    # Each FeatureDB is only used by one thread at a time, but not
+    # necessarily the one that made it.
+    db = sql.connect(':memory:', check_same_thread=False)
+    c = db.cursor()
     c.execute("""create table phdb
                 (phoneme text, voice text, place text, manner text)""")
     if notation == 'ipa':
@@ -93,68 +122,228 @@ def initialize(notation="ipa"):
     elif notation == 'digraph':
         for (ignore, ph, v, p, m) in DATA:
             c.execute("insert into phdb values (?,?,?,?)", (ph, v, p, m))
-    else:
-        raise Error("Unknown notation: %s" % notation)
-    phdb.commit()
+    db.commit()
+    return db
 
-def nasal_assimilate(ph1, ph2):
-    c = phdb.cursor()
-    m = c.execute("""select phoneme from phdb 
-        where (select manner from phdb where phoneme = ?) = 'nasal'
-        and manner = 'nasal'
-        and place = (select place from phdb where phoneme = ?)""", (ph1, ph2))
-    m = m.fetchall()
-    if len(m) == 0:
+def build_tables(db):
+    """Work out the answers of the SQL rules below for every pair of
+    phonemes in the database.  This is done directly in Python,
+    reading the table once; where a query's subselect would see the
+    first matching row, so does this.  Returns the assimilation and
+    metathesis tables and the set of phonemes."""
+    rows = db.cursor().execute(
+        "select phoneme, voice, place, manner from phdb").fetchall()
+    first = {}
+    for row in rows:
+        first.setdefault(row[0], row)
+    phonemes = list(first)
+    alveolar = set([r[0] for r in rows if r[2] == 'alveolar'])
+    movable = set([r[0] for r in rows if r[2] in ('velar', 'bilabial')
+                   and r[3] in ('stop', 'nasal')])
+    assim = {}
+    metathesis = {}
+    for ph1 in phonemes:
+        (ignore, v1, p1, m1) = first[ph1]
+        for ph2 in phonemes:
+            (ignore, v2, p2, m2) = first[ph2]
+            # voice_assimilate()
+            new = ph1
+            if m2 != 'nasal':
+                for r in rows:
+                    if r[2] == p1 and r[3] == m1 and r[1] == v2:
+                        new = r[0]
+                        break
+            # nasal_assimilate()
+            if first[new][3] == 'nasal':
+                for r in rows:
+                    if r[3] == 'nasal' and r[2] == p2:
+                        new = r[0]
+                        break
+            if new != ph1:
+                assim[(ph1, ph2)] = new
+            # coronal_metathesis()
+            if ph1 in alveolar and ph2 in movable and m1 == m2:
+                metathesis[(ph1, ph2)] = (ph2, ph1)
+    return (assim, metathesis, set(phonemes))
+
+def shared_tables(notation):
+    with tables_lock:
+        if notation not in TABLES:
+            db = connect(notation)
+            TABLES[notation] = build_tables(db)
+            db.close()
+        return TABLES[notation]
+
+
+class FeatureDB(object):
+    """The phoneme features of one notation ('ipa', 'digraph', or None
+    for none at all, when nothing ever assimilates), for one sound
+    system.  With fallback set, pairs involving phonemes the notation
+    doesn't know are looked up with SQL and remembered, in tables of
+    this FeatureDB's own."""
+    def __init__(self, notation='ipa', fallback=False):
+        if notation is not None and notation not in NOTATIONS:
+            raise ValueError("Unknown notation: %s" % notation)
+        self.notation = notation
+        self.fallback = fallback
+        self.setup()
+
+    def setup(self):
+        if self.notation is None:
+            (assim, metathesis, known) = ({}, {}, set())
+        else:
+            (assim, metathesis, known) = shared_tables(self.notation)
+        if self.fallback:
+            assim = dict(assim)
+            metathesis = dict(metathesis)
+        self.assim_table = assim
+        self.metathesis_table = metathesis
+        self.known = known
+        # Only the SQL versions of the rules need the database itself.
+        self.db = None
+
+    # A database connection can't be pickled; the tables are rebuilt
+    # (or, usually, just found again) on the other side.
+    def __getstate__(self):
+        return {'notation': self.notation, 'fallback': self.fallback}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.setup()
+
+    def cursor(self):
+        if self.db is None:
+            self.db = connect(self.notation)
+        return self.db.cursor()
+
+    def nasal_assimilate(self, ph1, ph2):
+        c = self.cursor()
+        m = c.execute("""select phoneme from phdb 
+            where (select manner from phdb where phoneme = ?) = 'nasal'
+            and manner = 'nasal'
+            and place = (select place from phdb where phoneme = ?)""", (ph1, ph2))
+        m = m.fetchall()
+        if len(m) == 0:
+            return ph1
+        else:
+            return m[0][0]
+
+    def voice_assimilate(self, ph1, ph2):
+        c = self.cursor()
+        m = c.execute("""select phoneme from phdb
+            where place = (select place from phdb where phoneme = ?)
+            and manner = (select manner from phdb where phoneme = ?)
+            and (select manner from phdb where phoneme = ?) != 'nasal'
+            and voice = (select voice from phdb where phoneme = ?)
+        """, (ph1, ph1, ph2, ph2))
+        m = m.fetchall()
+        if len(m) == 0:
+            return ph1
+        else:
+            return m[0][0]
+
+    def coronal_metathesis(self, ph1, ph2):
+        c = self.cursor()
+        m1 = c.execute("select phoneme from phdb where phoneme = ? and place = 'alveolar'", (ph1,))
+        m1 = m1.fetchall()
+        if len(m1) == 0:
+            return ph1, ph2
+        m2 = c.execute("""select phoneme from phdb
+            where phoneme = ? 
+            and place in ('velar', 'bilabial')
+            and manner in ('stop', 'nasal')
+            and (select manner from phdb where phoneme = ?) = (select manner from phdb where phoneme = ?)""", (ph2, ph2, ph1))
+        m2 = m2.fetchall()
+        if len(m2) == 0:
+            return ph1, ph2
+        else:
+            return ph2, ph1
+
+    def assimilate(self, ph1, ph2):
+        """Voicing, then nasal, assimilation of ph1 to a following ph2."""
+        pair = (ph1, ph2)
+        if pair in self.assim_table:
+            return self.assim_table[pair]
+        if self.fallback and (ph1 not in self.known or ph2 not in self.known):
+            new = self.nasal_assimilate(self.voice_assimilate(ph1, ph2), ph2)
+            self.assim_table[pair] = new
+            return new
         return ph1
-    else:
-        return m[0][0]
+
+    def metathesize(self, ph1, ph2):
+        pair = (ph1, ph2)
+        if pair in self.metathesis_table:
+            return self.metathesis_table[pair]
+        if self.fallback and (ph1 not in self.known or ph2 not in self.known):
+            swapped = self.coronal_metathesis(ph1, ph2)
+            self.metathesis_table[pair] = swapped
+            return swapped
+        return pair
+
+    # The "apply_" methods expect a word that has been split into
+    # an array of phonemes.
+    def apply_assimilations(self, word):
+        new = word[:]
+        if self.fallback:
+            for i in range(len(word) - 1):
+                new[i] = self.assimilate(word[i], word[i+1])
+            return new
+        get = self.assim_table.get
+        for i in range(len(word) - 1):
+            new[i] = get((word[i], word[i+1]), word[i])
+        return new
+
+    def apply_coronal_metathesis(self, word):
+        new = word[:]
+        if self.fallback:
+            for i in range(len(word) - 1):
+                new[i], new[i+1] = self.metathesize(word[i], word[i+1])
+            return new
+        table = self.metathesis_table
+        for i in range(len(word) - 1):
+            pair = (word[i], word[i+1])
+            if pair in table:
+                new[i], new[i+1] = table[pair]
+            else:
+                new[i], new[i+1] = pair
+        return new
+
+
+def initialize(notation="ipa", fallback=False):
+    """Set up the default FeatureDB, which the functions below use."""
+    global default, phdb, assim_table, metathesis_table, known, sql_fallback
+    default = FeatureDB(notation, fallback)
+    default.cursor()
+    phdb = default.db
+    assim_table = default.assim_table
+    metathesis_table = default.metathesis_table
+    known = default.known
+    sql_fallback = fallback
+
+def nasal_assimilate(ph1, ph2):
+    return default.nasal_assimilate(ph1, ph2)
 
 def voice_assimilate(ph1, ph2):
-    c = phdb.cursor()
-    m = c.execute("""select phoneme from phdb
-        where place = (select place from phdb where phoneme = ?)
-        and manner = (select manner from phdb where phoneme = ?)
-        and (select manner from phdb where phoneme = ?) != 'nasal'
-        and voice = (select voice from phdb where phoneme = ?)
-    """, (ph1, ph1, ph2, ph2))
-    m = m.fetchall()
-    if len(m) == 0:
-        return ph1
-    else:
-        return m[0][0]
-    
+    return default.voice_assimilate(ph1, ph2)
+
 def coronal_metathesis(ph1, ph2):
-    c = phdb.cursor()
-    m1 = c.execute("select phoneme from phdb where phoneme = ? and place = 'alveolar'", (ph1,))
-    m1 = m1.fetchall()
-    if len(m1) == 0:
-        return ph1, ph2
-    m2 = c.execute("""select phoneme from phdb
-        where phoneme = ? 
-        and place in ('velar', 'bilabial')
-        and manner in ('stop', 'nasal')
-        and (select manner from phdb where phoneme = ?) = (select manner from phdb where phoneme = ?)""", (ph2, ph2, ph1))
-    m2 = m2.fetchall()
-    if len(m2) == 0:
-        return ph1, ph2
-    else:
-        return ph2, ph1
-
-
-# The "apply_" functions expect a word that has been split into
-# an array of phonemes.
+    return default.coronal_metathesis(ph1, ph2)
+
+def assimilate(ph1, ph2):
+    """Voicing, then nasal, assimilation of ph1 to a following ph2."""
+    return default.assimilate(ph1, ph2)
+
+def metathesize(ph1, ph2):
+    return default.metathesize(ph1, ph2)
+
 def apply_assimilations(word):
-    new = word[:]
-    for i in range(len(word) - 1):
-        new[i] = voice_assimilate(word[i], word[i+1])
-        new[i] = nasal_assimilate(new[i], word[i+1])
-    return new
-#
+    return default.apply_assimilations(word)
+
 def apply_coronal_metathesis(word):
-    new = word[:]
-    for i in range(len(word) - 1):
-        new[i], new[i+1] = coronal_metathesis(word[i], word[i+1])
-    return new
+    return default.apply_coronal_metathesis(word)
+
+# Until initialize() is called, nothing assimilates.
+default = FeatureDB(None)
 
 # Testing...
 if __name__ == '__main__':
@@ -165,3 +354,56 @@ if __name__ == '__main__':
     word2 = apply_assimilations(word1)
     print(word2)
     print(apply_coronal_metathesis(word2))
+
+    # The tables must agree with the SQL queries for every pair.
+    for notation in ('ipa', 'digraph'):
+        initialize(notation)
+        for ph1 in known:
+            for ph2 in known:
+                new = nasal_assimilate(voice_assimilate(ph1, ph2), ph2)
+                assert assimilate(ph1, ph2) == new, (ph1, ph2)
+                assert metathesize(ph1, ph2) == coronal_metathesis(ph1, ph2)
+        print("%s: tables match SQL for all %d pairs" %
+              (notation, len(known) ** 2))
+    initialize()
+
+    # Sound systems with different notations can be used side by side,
+    # and those with the same one share its tables.
+    ipa = FeatureDB('ipa')
+    digraph = FeatureDB('digraph')
+    assert ipa.apply_assimilations(['a', 'n', 'k']) == ['a', 'ŋ', 'k']
+    assert digraph.apply_assimilations(['a', 'n', 'k']) == ['a', 'ng', 'k']
+    assert ipa.assim_table is FeatureDB('ipa').assim_table
+    assert FeatureDB(None).apply_assimilations(['n', 'k']) == ['n', 'k']
+
+    # Benchmark: the lookup tables against the SQL queries they
+    # replace, checking on the way that both give the same answers.
+    import random
+    import time
+
+    def sql_assimilations(word):
+        new = word[:]
+        for i in range(len(word) - 1):
+            new[i] = voice_assimilate(word[i], word[i+1])
+            new[i] = nasal_assimilate(new[i], word[i+1])
+        return new
+
+    def sql_coronal_metathesis(word):
+        new = word[:]
+        for i in range(len(word) - 1):
+            new[i], new[i+1] = coronal_metathesis(word[i], word[i+1])
+        return new
+
+    random.seed(1)
+    inventory = [row[0] for row in DATA] + ['a', 'i', 'u', 'h']
+    words = [[random.choice(inventory) for j in range(random.randint(2, 9))]
+             for i in range(5000)]
+    start = time.perf_counter()
+    slow = [sql_coronal_metathesis(sql_assimilations(w)) for w in words]
+    sql_time = time.perf_counter() - start
+    start = time.perf_counter()
+    fast = [apply_coronal_metathesis(apply_assimilations(w)) for w in words]
+    table_time = time.perf_counter() - start
+    assert slow == fast
+    print("%d words: sql %.3fs, tables %.4fs (%.0fx faster)" %
+          (len(words), sql_time, table_time, sql_time / table_time))
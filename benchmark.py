@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015-2016 William S. Annis
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Timings for the slow parts of Lexifer.
+
+For each definition file this times parsing, and then, for each word
+count, the separate steps of making that many words: drawing them from
+the rules (run_rule), the assimilation and metathesis pass, the
+filters (apply_filters), sorting the survivors and making a paragraph
+of about that many words (textify).  Then the whole job, as
+iter_words() does it, drawing and rejecting (generate) and steering
+clear of the rejections (constrained); these records also have the
+yield, the fraction of candidate words kept.  Each timing is the best of
+several repeats, each starting from a freshly parsed phonology with
+the same seed, so every repeat does exactly the same work.
+
+The results are written as JSON, one record per file, step and count.
+Give --compare an earlier results file to see how the two differ.
+
+    python3 benchmark.py -o bench_output.txt
+    python3 benchmark.py --compare bench_output.txt
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import time
+from PhDefParser import PhonologyDefinition
+from wordgen import SoundSystem, textify
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FILES = ['test.def', 'examples/hungarian.def', 'examples/laadan.def',
+                 'examples/test2.def']
+DEFAULT_COUNTS = [100, 1000, 10000]
+STEPS = ['parse', 'run_rule', 'assimilation', 'apply_filters', 'sort',
+         'textify', 'generate', 'constrained']
+
+# Roughly how many words textify() makes per sentence.
+WORDS_PER_SENTENCE = 8
+
+
+def load(fname, seed):
+    soundsys = SoundSystem(seed)
+    # test2.def deliberately uses letters its 'letters:' line doesn't
+    # list; sort those last rather than stopping.
+    soundsys.unknown_letters = 'last'
+    # The parser's warnings would be repeated for every load.
+    with contextlib.redirect_stderr(io.StringIO()):
+        return PhonologyDefinition(soundsys, fname).soundsys
+
+
+def best_of(repeats, fn):
+    """Smallest wall-clock time of repeats calls to fn()."""
+    best = None
+    for r in range(repeats):
+        start = time.perf_counter()
+        fn()
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def time_steps(fname, n, seed, repeats):
+    """Time each word-making step for n words.  Returns {step: seconds}
+    and {step: yield} for the steps that have one; a step the
+    phonology doesn't use (no 'letters:', so no assimilation) is
+    None."""
+    times = dict([(step, None) for step in STEPS[1:]])
+    yields = {}
+    for r in range(repeats):
+        ss = load(fname, seed)
+        t = {}
+        start = time.perf_counter()
+        raw = [ss.run_rule(ss.select_rule()) for i in range(n)]
+        t['run_rule'] = time.perf_counter() - start
+
+        if ss.sorter:
+            # The same work apply_filters() does before the filters
+            # proper, with both passes on whatever the file asks for.
+            start = time.perf_counter()
+            features = ss.features
+            for word in raw:
+                features.apply_coronal_metathesis(
+                    features.apply_assimilations(ss.sorter.split(word)))
+            t['assimilation'] = time.perf_counter() - start
+            # Don't let apply_filters() profit from the splits made here.
+            ss.sorter.cache.clear()
+
+        start = time.perf_counter()
+        words = [ss.apply_filters(word) for word in raw]
+        t['apply_filters'] = time.perf_counter() - start
+
+        if ss.sorter:
+            words = [w for w in words if w != 'REJECT']
+            start = time.perf_counter()
+            ss.sorter(words)
+            t['sort'] = time.perf_counter() - start
+
+        ss.seed(seed)
+        start = time.perf_counter()
+        textify(ss, max(1, n // WORDS_PER_SENTENCE))
+        t['textify'] = time.perf_counter() - start
+
+        # Duplicates allowed, so that the yield is down to the
+        # rejections alone.
+        for step in ('generate', 'constrained'):
+            ss = load(fname, seed)
+            ss.constrained = step == 'constrained'
+            start = time.perf_counter()
+            for word in ss.iter_words(n, unique=False):
+                pass
+            t[step] = time.perf_counter() - start
+            yields[step] = ss.stats.yield_rate()
+
+        for (step, secs) in t.items():
+            if times[step] is None or secs < times[step]:
+                times[step] = secs
+    return (times, yields)
+
+
+def run(files, counts, seed, repeats, log):
+    results = []
+    for fname in files:
+        path = fname if os.path.isabs(fname) else os.path.join(HERE, fname)
+        secs = best_of(repeats, lambda: load(path, seed))
+        results.append({'file': fname, 'step': 'parse', 'n': 1,
+                        'seconds': secs})
+        log("%-24s %-14s %8s %10.4fs\n" % (fname, 'parse', '', secs))
+        for n in counts:
+            (times, yields) = time_steps(path, n, seed, repeats)
+            for step in STEPS[1:]:
+                rec = {'file': fname, 'step': step, 'n': n,
+                       'seconds': times[step]}
+                if step in yields:
+                    rec['yield'] = yields[step]
+                results.append(rec)
+                if times[step] is None:
+                    continue
+                if step in yields:
+                    log("%-24s %-14s %8d %10.4fs  yield %.1f%%\n" %
+                        (fname, step, n, times[step], 100 * yields[step]))
+                else:
+                    log("%-24s %-14s %8d %10.4fs\n" %
+                        (fname, step, n, times[step]))
+    return results
+
+
+def compare(old, new):
+    """Print new timings against old ones, as a ratio (above 1 is slower)."""
+    before = {}
+    for rec in old['results']:
+        before[(rec['file'], rec['step'], rec['n'])] = rec['seconds']
+    for rec in new['results']:
+        was = before.get((rec['file'], rec['step'], rec['n']))
+        if was is None or rec['seconds'] is None:
+            continue
+        ratio = rec['seconds'] / was if was else float('inf')
+        print("%-24s %-14s %8d %10.4fs %10.4fs %7.2fx" %
+              (rec['file'], rec['step'], rec['n'], was, rec['seconds'], ratio))
+
+
+def main():
+    opt = argparse.ArgumentParser(description="Time Lexifer's hot paths.")
+    opt.add_argument("files", nargs='*', default=DEFAULT_FILES,
+                     help="definition files (default: test.def and the "
+                          "examples)")
+    opt.add_argument("-n", "--counts", type=int, nargs='+',
+                     default=DEFAULT_COUNTS, help="word counts to time")
+    opt.add_argument("-r", "--repeats", type=int, default=3,
+                     help="repeats of each timing; the best is kept")
+    opt.add_argument("--seed", type=int, default=1)
+    opt.add_argument("-o", "--output", help="write the JSON here")
+    opt.add_argument("--compare", metavar="FILE",
+                     help="an earlier results file to compare against")
+    opt.add_argument("-q", "--quiet", action="store_true")
+    args = opt.parse_args()
+
+    log = (lambda s: None) if args.quiet else sys.stderr.write
+    with open(os.path.join(HERE, 'VERSION')) as f:
+        version = f.read().strip()
+    report = {
+        'version': version,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'seed': args.seed,
+        'repeats': args.repeats,
+        'results': run(args.files, args.counts, args.seed, args.repeats, log),
+    }
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            compare(json.load(f), report)
+    text = json.dumps(report, indent=1)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    elif not args.compare:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
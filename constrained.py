@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015-2016 William S. Annis
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Drawing words that the rejections won't throw out.
+
+Ordinarily a word is drawn from its rule and then filtered, and a word
+that hits a 'reject:' pattern (or a '-' in a cluster field) is thrown
+away and another drawn.  With dense rejections most of the work is
+wasted.  A ConstrainedSampler instead keeps track, as each phoneme is
+drawn, of how far the word so far has got into every rejection
+pattern, and only draws phonemes that don't complete one.  The weights
+of the phonemes still allowed keep their proportions.
+
+The patterns are matched by an Aho-Corasick automaton, so only
+rejections that match a finite set of strings can be steered around:
+plain text, and regular expressions built from classes, alternatives,
+'?' and bounded repeats, with '^' and '$' at the ends.  Anything else
+(and any rejection after the first filter that changes words) is left
+to the filters, which still run on every word afterwards.
+
+Rejections look at the word after assimilation and metathesis, which
+can change a phoneme depending on the one after it.  The automaton is
+therefore fed the finished letters only once nothing drawn later can
+change them, which means a doomed phoneme is sometimes noticed only a
+draw or two later.  If by then no phoneme is allowed the word is
+abandoned: a dead end, counted in GenerationStats.
+
+Words come out with slightly different frequencies from the usual
+draw-and-reject, since a choice is renormalized over what's allowed
+at that point rather than over whole words.
+"""
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+from filters import FilterChain
+from opcodes import LITERAL, OPTIONAL, NOREPEAT
+
+
+# Don't steer around a rejection that stands for more strings than this.
+EXPANSION_LIMIT = 1000
+
+# Largest range in a character class that is written out letter by letter.
+RANGE_LIMIT = 64
+
+# Longest bounded repeat ('x{2,5}') that is expanded.
+REPEAT_LIMIT = 4
+
+# Stand-ins for the start and end of the word, which '^' and '$' match.
+START = '\x02'
+END = '\x03'
+
+# How many slots of a rule past the one being drawn are checked for a
+# way on.  Enough to see past the letters assimilation and metathesis
+# are still waiting on, without searching whole words.
+HORIZON = 3
+
+# How many steps and choices a sampler remembers.
+CACHE_SIZE = 1000000
+
+
+def expand_pattern(pat, limit=EXPANSION_LIMIT):
+    """Every string the regular expression pat can match, as a set,
+    with START and END standing for '^' and '$'.  None if pat can
+    match infinitely many strings, or more than limit, or uses
+    anything not handled here."""
+    try:
+        parsed = sre_parse.parse(pat)
+    except Exception:
+        return None
+    if parsed.state.flags & ~sre_constants.SRE_FLAG_UNICODE:
+        return None
+    items = list(parsed)
+    prefix = suffix = ''
+    at = sre_constants.AT
+    if items and items[0] == (at, sre_constants.AT_BEGINNING):
+        prefix = START
+        items = items[1:]
+    if items and items[-1] == (at, sre_constants.AT_END):
+        suffix = END
+        items = items[:-1]
+    strings = expand_sequence(items, limit)
+    if strings is None or '' in strings:
+        # A rejection matching nothing at all is better left alone.
+        return None
+    return set([prefix + s + suffix for s in strings])
+
+
+def expand_sequence(items, limit):
+    strings = set([''])
+    for (op, av) in items:
+        choices = expand_item(op, av, limit)
+        if choices is None or len(strings) * len(choices) > limit:
+            return None
+        strings = set([s + c for s in strings for c in choices])
+    return strings
+
+
+def expand_item(op, av, limit):
+    c = sre_constants
+    if op == c.LITERAL:
+        return set([chr(av)])
+    elif op == c.IN:
+        chars = set()
+        for (kind, arg) in av:
+            if kind == c.LITERAL:
+                chars.add(chr(arg))
+            elif kind == c.RANGE and arg[1] - arg[0] < RANGE_LIMIT:
+                chars.update([chr(i) for i in range(arg[0], arg[1] + 1)])
+            else:
+                # Negated classes, \d and the like.
+                return None
+        return chars
+    elif op == c.BRANCH:
+        strings = set()
+        for sub in av[1]:
+            more = expand_sequence(list(sub), limit)
+            if more is None:
+                return None
+            strings |= more
+        return strings
+    elif op == c.SUBPATTERN:
+        (group, add_flags, del_flags, sub) = av
+        if add_flags or del_flags:
+            return None
+        return expand_sequence(list(sub), limit)
+    elif op in (c.MAX_REPEAT, c.MIN_REPEAT):
+        (low, high, sub) = av
+        if high == c.MAXREPEAT or high > REPEAT_LIMIT:
+            return None
+        once = expand_sequence(list(sub), limit)
+        if once is None:
+            return None
+        strings = set()
+        for count in range(low, high + 1):
+            more = set([''])
+            for i in range(count):
+                more = set([s + t for s in more for t in once])
+                if len(more) > limit:
+                    return None
+            strings |= more
+        return strings
+    # Anchors in the middle, '.', lookarounds, backreferences...
+    return None
+
+
+class RejectAutomaton(object):
+    """An Aho-Corasick automaton for a set of strings.  States are
+    ints, 0 being the start; feed() gives the state after some more
+    text, or None if the text so far contains one of the strings."""
+    def __init__(self, strings):
+        goto = [{}]
+        found = [False]
+        for s in strings:
+            q = 0
+            for ch in s:
+                nxt = goto[q].get(ch)
+                if nxt is None:
+                    nxt = goto[q][ch] = len(goto)
+                    goto.append({})
+                    found.append(False)
+                q = nxt
+            found[q] = True
+        # Failure links, breadth first.
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for q in queue:
+            for (ch, r) in goto[q].items():
+                queue.append(r)
+                f = fail[q]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[r] = goto[f].get(ch, 0)
+                found[r] = found[r] or found[fail[r]]
+        self.goto = goto
+        self.fail = fail
+        self.found = found
+        # Transitions are worked out as they are needed, then kept.
+        self.delta = [{} for q in goto]
+
+    def step(self, q, ch):
+        d = self.delta[q]
+        r = d.get(ch)
+        if r is None:
+            goto = self.goto
+            f = q
+            while f and ch not in goto[f]:
+                f = self.fail[f]
+            r = d[ch] = goto[f].get(ch, 0)
+        return r
+
+    def feed(self, q, text):
+        found = self.found
+        for ch in text:
+            q = self.step(q, ch)
+            if found[q]:
+                return None
+        return q
+
+    def __len__(self):
+        return len(self.goto)
+
+
+def leading_rejects(filters):
+    """The rejections that come before any filter that changes words,
+    which therefore all see the word just as it was drawn."""
+    pats = []
+    for (pat, repl) in filters:
+        if repl != 'REJECT':
+            break
+        pats.append(pat)
+    return pats
+
+
+class ConstrainedSampler(object):
+    def __init__(self, soundsys):
+        self.soundsys = soundsys
+        strings = set()
+        self.steered = []
+        steered = []
+        for (i, pat) in enumerate(leading_rejects(soundsys.filters)):
+            expanded = expand_pattern(pat)
+            if expanded is not None:
+                strings |= expanded
+                self.steered.append(pat)
+                steered.append(i)
+        self.automaton = RejectAutomaton(strings)
+        # Words drawn here can't match the steered rejections, so the
+        # filters that still have to run are the rest.
+        self.chain = FilterChain(soundsys.filters, steered)
+
+        # Without assimilation or metathesis the word rejections see
+        # is the word drawn.  With them, the letters have to be split
+        # as apply_filters() splits them.
+        sorter = soundsys.sorter
+        self.features = soundsys.features
+        self.use_assim = sorter is not None and soundsys.use_assim
+        self.use_meta = (sorter is not None and
+                         soundsys.use_coronal_metathesis)
+        if self.use_assim or self.use_meta:
+            self.splitter = sorter.splitter
+            # A letter ending one of these might yet become part of a
+            # longer one.
+            self.prefixes = set()
+            for g in sorter.graphs:
+                for i in range(1, len(g)):
+                    self.prefixes.add(g[:i])
+        else:
+            self.splitter = None
+        # Each pass looks one letter ahead.
+        self.lookahead = int(self.use_assim) + int(self.use_meta)
+        self.clear()
+        self.start = self.advance((0, '', 0), START)
+
+    def clear(self):
+        self.steps = {}
+        self.choices = {}
+        self.ends = {}
+        self.shapes = {}
+        self.living = {}
+
+    # The caches hold selectors tied to this process's random number
+    # generator; let a copy build its own.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['steps'] = {}
+        state['choices'] = {}
+        state['ends'] = {}
+        state['shapes'] = {}
+        state['living'] = {}
+        return state
+
+    def finished(self, letters):
+        """What assimilation and metathesis make of a list of letters."""
+        if self.use_assim:
+            letters = self.features.apply_assimilations(letters)
+        if self.use_meta:
+            letters = self.features.apply_coronal_metathesis(letters)
+        return letters
+
+    # A state is (automaton state, text, context).  text is the end of
+    # the word so far that the automaton hasn't seen yet, because later
+    # draws could still change it.  With metathesis, the last letter
+    # the automaton has seen is kept at the start of text (context is
+    # then 1), since metathesis of the last two letters of a word
+    # looks back at it.
+    def advance(self, state, more):
+        """The state after drawing more, or None if that makes the
+        word one a steered rejection will throw out."""
+        key = (state, more)
+        if key in self.steps:
+            return self.steps[key]
+        (q, text, context) = state
+        if self.splitter is None or more == START:
+            q = self.automaton.feed(q, more)
+            nxt = None if q is None else (q, '', 0)
+        else:
+            text += more
+            letters = self.splitter.findall(text)
+            # Letters are split off longest first, so a letter is
+            # settled once the text from there on can't be the start
+            # of a longer one.
+            pos = 0
+            settled = 0
+            for g in letters:
+                if text[pos:] in self.prefixes:
+                    break
+                pos += len(g)
+                settled += 1
+            done = max(context, settled - self.lookahead)
+            new = self.finished(letters[:settled])[context:done]
+            q = self.automaton.feed(q, "".join(new))
+            if q is None:
+                nxt = None
+            else:
+                keep = 1 if self.use_meta and done > 0 else 0
+                pos = sum([len(g) for g in letters[:done - keep]])
+                nxt = (q, text[pos:], keep)
+        if len(self.steps) >= CACHE_SIZE:
+            self.steps.clear()
+        self.steps[key] = nxt
+        return nxt
+
+    def finish(self, state):
+        """Whether a word that ends in this state gets past the steered
+        rejections."""
+        ok = self.ends.get(state)
+        if ok is None:
+            (q, text, context) = state
+            if self.splitter is not None:
+                letters = self.finished(self.splitter.findall(text))
+                text = "".join(letters[context:])
+            else:
+                text = ''
+            ok = self.automaton.feed(q, text + END) is not None
+            if len(self.ends) >= CACHE_SIZE:
+                self.ends.clear()
+            self.ends[state] = ok
+        return ok
+
+    def shape(self, rule):
+        """The rule's plan, and for each slot whether what comes next
+        depends on the phoneme drawn before it: true for a '!' slot
+        and any optional slots leading up to one."""
+        shape = self.shapes.get(rule)
+        if shape is None:
+            plan = self.soundsys.plans.get(rule)
+            if plan is None:
+                plan = self.soundsys.plans[rule] = \
+                    self.soundsys.compile_rule(rule)
+            needs = [False] * (len(plan) + 1)
+            for i in range(len(plan) - 1, -1, -1):
+                op = plan[i][0]
+                needs[i] = op == NOREPEAT or (op == OPTIONAL and needs[i+1])
+            shape = self.shapes[rule] = (plan, needs)
+        return shape
+
+    def options(self, rule, i, state, prev):
+        """What may be drawn for slot i of the rule, in this state and
+        after the phoneme prev.  Returns (picker, nexts, skip): a
+        selector over the phonemes allowed, with the same relative
+        weights (None if there are none), the state each of them
+        leads to, and whether an optional slot may be left out.  A
+        literal's nexts are empty if it isn't allowed."""
+        (plan, needs) = self.shape(rule)
+        if not needs[i]:
+            prev = None
+        key = (rule, i, state, prev)
+        entry = self.choices.get(key)
+        if entry is not None:
+            return entry
+        (op, arg) = plan[i]
+        nexts = {}
+        if op == LITERAL:
+            nxt = self.advance(state, arg)
+            if nxt is not None and self.alive(rule, i + 1, nxt, arg):
+                nexts[arg] = nxt
+            entry = (None, nexts, False)
+        else:
+            allowed = {}
+            for (ph, weight) in zip(arg.keys, arg.weights):
+                if op == NOREPEAT and ph == prev:
+                    continue
+                nxt = self.advance(state, ph)
+                if nxt is not None and self.alive(rule, i + 1, nxt, ph):
+                    allowed[ph] = weight
+                    nexts[ph] = nxt
+            if not allowed:
+                picker = None
+            elif len(allowed) == arg.n:
+                # Nothing to steer around: draw just as run_plan() does.
+                picker = arg
+            else:
+                picker = self.soundsys.selector(allowed)
+            skip = op == OPTIONAL and self.alive(rule, i + 1, state, prev)
+            entry = (picker, nexts, skip)
+        if len(self.choices) >= CACHE_SIZE:
+            self.choices.clear()
+        self.choices[key] = entry
+        return entry
+
+    def alive(self, rule, i, state, prev, horizon=HORIZON):
+        """Whether the next horizon slots of the rule, from slot i, can
+        be drawn without the word being rejected (and, if they are
+        the last, finished)."""
+        (plan, needs) = self.shape(rule)
+        if i == len(plan):
+            return self.finish(state)
+        if horizon == 0:
+            return True
+        if not needs[i]:
+            prev = None
+        key = (rule, i, state, prev, horizon)
+        ok = self.living.get(key)
+        if ok is None:
+            (op, arg) = plan[i]
+            ok = False
+            if op == LITERAL:
+                nxt = self.advance(state, arg)
+                ok = (nxt is not None and
+                      self.alive(rule, i + 1, nxt, arg, horizon - 1))
+            elif op == OPTIONAL and self.alive(rule, i + 1, state, prev,
+                                               horizon - 1):
+                ok = True
+            else:
+                for ph in arg.keys:
+                    if op == NOREPEAT and ph == prev:
+                        continue
+                    nxt = self.advance(state, ph)
+                    if (nxt is not None and
+                            self.alive(rule, i + 1, nxt, ph, horizon - 1)):
+                        ok = True
+                        break
+            if len(self.living) >= CACHE_SIZE:
+                self.living.clear()
+            self.living[key] = ok
+        return ok
+
+    def run_rule(self, rule):
+        """Like SoundSystem.run_plan() on the rule's plan, but steering
+        clear of the rejections.  Returns the list of phonemes, or
+        None if the rule can't make a word that gets past them."""
+        soundsys = self.soundsys
+        (plan, needs) = self.shape(rule)
+        state = self.start
+        prev = None
+        s = []
+        for i in range(len(plan)):
+            (op, arg) = plan[i]
+            (picker, nexts, skip) = self.options(rule, i, state, prev)
+            if op == LITERAL:
+                if not nexts:
+                    return None
+                ph = arg
+            else:
+                if op == OPTIONAL:
+                    # The same coin run_plan() tosses, unless only one
+                    # way on is left.
+                    include = (soundsys.rng.random() * 101 <
+                               soundsys.randpercent)
+                    if picker is None:
+                        include = False
+                    elif not skip:
+                        include = True
+                    if not include:
+                        if not skip:
+                            return None
+                        continue
+                elif picker is None:
+                    return None
+                ph = picker.select()
+            state = nexts[ph]
+            s.append(ph)
+            prev = ph
+        if not self.finish(state):
+            return None
+        return s
+
+    def forbids(self, word):
+        """Whether a steered rejection throws out this word (as drawn)."""
+        state = self.advance(self.start, word)
+        return state is None or not self.finish(state)
+
+
+# Testing...  A word is forbidden exactly when one of the steered
+# rejections matches it after assimilation, however it is cut up as
+# it is drawn.  Then the yield of steered drawing against plain
+# drawing and rejecting.
+if __name__ == '__main__':
+    import contextlib
+    import glob
+    import io
+    import os
+    import re
+    import time
+    from PhDefParser import PhonologyDefinition
+    from wordgen import SoundSystem
+
+    def load(fname, seed=1):
+        soundsys = SoundSystem(seed)
+        soundsys.unknown_letters = 'last'
+        with contextlib.redirect_stderr(io.StringIO()):
+            return PhonologyDefinition(soundsys, fname).soundsys
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    defs = [os.path.join(here, 'test.def')]
+    defs += sorted(glob.glob(os.path.join(here, 'examples', '*.def')))
+
+    assert expand_pattern('^j(i|í)[ab]x?$') == set(
+        [START + 'j' + v + c + x + END
+         for v in 'ií' for c in 'ab' for x in ('', 'x')])
+    for pat in ('a.', 'a+', '(?=a)b', r'(a)\1', '[^a]', 'x{2,}', '(?i)a'):
+        assert expand_pattern(pat) is None, pat
+
+    for fname in defs:
+        ss = load(fname)
+        ss.compile()
+        sampler = ConstrainedSampler(ss)
+        regexes = [re.compile(p) for p in sampler.steered]
+        forbidden = 0
+        for i in range(20000):
+            plan = ss.plans[ss.select_rule()]
+            phonemes = ss.run_plan(plan)
+            word = "".join(phonemes)
+            final = word
+            if ss.sorter:
+                final = "".join(sampler.finished(ss.sorter.split(word)))
+            expected = any([r.search(final) for r in regexes])
+            # Fed a phoneme at a time, as run_plan() does.
+            state = sampler.start
+            for ph in phonemes:
+                if state is not None:
+                    state = sampler.advance(state, ph)
+            got = state is None or not sampler.finish(state)
+            assert got == expected == sampler.forbids(word), (fname, word)
+            if got:
+                forbidden += 1
+                assert ss.apply_filters(word) == 'REJECT', (fname, word)
+            else:
+                # Leaving out the steered rejections changes nothing.
+                assert (sampler.chain.apply(final) ==
+                        ss.filter_chain.apply(final)), (fname, word)
+        print("%s: %d of %d rejections steered, %d automaton states, "
+              "%d of 20000 words forbidden" %
+              (os.path.basename(fname), len(sampler.steered),
+               len([f for f in ss.filters if f[1] == 'REJECT']),
+               len(sampler.automaton), forbidden))
+
+    print()
+    print("%-16s %-12s %8s %8s %9s %8s %8s" %
+          ("file", "sampling", "attempts", "words", "dead ends", "yield",
+           "time"))
+    for fname in defs:
+        for constrained in (False, True):
+            ss = load(fname)
+            ss.constrained = constrained
+            start = time.perf_counter()
+            words = list(ss.iter_words(5000, unique=False))
+            secs = time.perf_counter() - start
+            st = ss.stats
+            print("%-16s %-12s %8d %8d %9d %7.1f%% %7.3fs" %
+                  (os.path.basename(fname),
+                   "constrained" if constrained else "plain",
+                   st.attempts, st.words, st.dead_ends,
+                   100 * st.yield_rate(), secs))
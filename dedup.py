@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015-2016 William S. Annis
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Ways of remembering which words have already been generated.
+
+A plain set of strings is fastest, but costs something like 100 bytes
+a word.  The alternatives only keep a hash of each word:
+
+    compact  64-bit hashes in an open-addressing table, 11 to 23 bytes
+             a word.  Exact unless two words share a hash, which for
+             n words has odds of about n**2 / 2**65: one in 370,000
+             for ten million words.
+    bloom    A Bloom filter, under 2 bytes a word.  Now and then a new
+             word is taken for one already seen (one time in a
+             thousand, by default) and skipped, so output stays unique
+             but a few possible words go missing.
+
+All of them have the set methods iter_words() needs: add(), 'in' and
+len().
+"""
+
+from array import array
+from hashlib import blake2b
+import math
+
+
+KINDS = ('set', 'compact', 'bloom')
+
+# Highest fraction of a CompactSet's slots in use before it grows.
+MAX_LOAD = 0.7
+
+# Words a BloomFilter is sized for when we aren't told how many there
+# will be, and its chance of mistaking a new word for an old one.
+BLOOM_CAPACITY = 1000000
+BLOOM_ERROR = 0.001
+
+
+def word_hash(word, size=8):
+    return int.from_bytes(blake2b(word.encode('utf-8'),
+                                  digest_size=size).digest(), 'little')
+
+
+class CompactSet(object):
+    def __init__(self, capacity=0):
+        size = 1024
+        while size * MAX_LOAD < capacity:
+            size *= 2
+        self.table = array('Q', [0]) * size
+        self.mask = size - 1
+        self.count = 0
+        # 'word in s' followed by s.add(word) is the usual pattern, so
+        # remember the last hash rather than working it out twice.
+        self.last = (None, 0)
+
+    def hash(self, word):
+        if self.last[0] == word:
+            return self.last[1]
+        # Zero marks an empty slot.
+        h = word_hash(word) or 1
+        self.last = (word, h)
+        return h
+
+    def find(self, h):
+        """The slot holding h, or the empty one where it would go."""
+        table = self.table
+        mask = self.mask
+        i = h & mask
+        while True:
+            v = table[i]
+            if v == h or v == 0:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, word):
+        h = self.hash(word)
+        return self.table[self.find(h)] == h
+
+    def add(self, word):
+        h = self.hash(word)
+        i = self.find(h)
+        if self.table[i] == h:
+            return
+        self.table[i] = h
+        self.count += 1
+        if self.count > len(self.table) * MAX_LOAD:
+            self.grow()
+
+    def grow(self):
+        old = self.table
+        self.table = array('Q', [0]) * (2 * len(old))
+        self.mask = len(self.table) - 1
+        for h in old:
+            if h:
+                self.table[self.find(h)] = h
+
+    def __len__(self):
+        return self.count
+
+    def update(self, words):
+        for word in words:
+            self.add(word)
+
+
+class BloomFilter(object):
+    def __init__(self, capacity=BLOOM_CAPACITY, error=BLOOM_ERROR):
+        """Sized for capacity words at the given false positive rate.
+        Past that it adds another, larger filter rather than letting
+        the rate climb."""
+        self.error = error
+        self.layers = []
+        self.count = 0
+        self.last = (None, None)
+        self.add_layer(max(capacity, 1), error)
+
+    def add_layer(self, capacity, error):
+        bits = int(-capacity * math.log(error) / math.log(2) ** 2) + 1
+        k = max(1, int(round(bits / capacity * math.log(2))))
+        # (bit array, number of bits, number of hashes, capacity)
+        self.layers.append((bytearray((bits + 7) // 8), bits, k, capacity))
+        self.room = capacity
+
+    def hash(self, word):
+        # As in CompactSet, the last word's hash is kept.  Double
+        # hashing gets all the bit positions from two 64-bit halves.
+        if self.last[0] == word:
+            return self.last[1]
+        h = word_hash(word, 16)
+        hashes = (h & 0xffffffffffffffff, h >> 64)
+        self.last = (word, hashes)
+        return hashes
+
+    def __contains__(self, word):
+        (h1, h2) = self.hash(word)
+        for (arr, bits, k, capacity) in self.layers:
+            for i in range(k):
+                p = (h1 + i * h2) % bits
+                if not arr[p >> 3] & (1 << (p & 7)):
+                    break
+            else:
+                return True
+        return False
+
+    def add(self, word):
+        if word in self:
+            return
+        if self.room == 0:
+            # Halving the rate each time keeps the total under twice
+            # the first layer's.
+            (arr, bits, k, capacity) = self.layers[-1]
+            self.add_layer(2 * capacity, self.error / 2 ** len(self.layers))
+        (arr, bits, k, capacity) = self.layers[-1]
+        (h1, h2) = self.hash(word)
+        for i in range(k):
+            p = (h1 + i * h2) % bits
+            arr[p >> 3] |= 1 << (p & 7)
+        self.room -= 1
+        self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def update(self, words):
+        for word in words:
+            self.add(word)
+
+
+def new_seen(kind='set', capacity=None):
+    """An empty container of the given kind (one of KINDS), with room
+    for capacity words if that's known."""
+    if kind == 'set':
+        return set()
+    elif kind == 'compact':
+        return CompactSet(capacity or 0)
+    elif kind == 'bloom':
+        return BloomFilter(capacity or BLOOM_CAPACITY)
+    raise ValueError("Unknown kind of duplicate check: %s" % kind)
+
+
+# Testing...  Every kind has to agree with a set (the Bloom filter
+# allowing for its false positives), and the compact kinds had better
+# actually be compact.
+if __name__ == '__main__':
+    import random
+    import sys
+
+    rng = random.Random(1)
+    letters = 'ptkbdgmnszaeiou'
+    words = ["".join([rng.choice(letters) for i in range(rng.randint(2, 9))])
+             for j in range(200000)]
+    for kind in KINDS:
+        seen = new_seen(kind, 10000)
+        exact = set()
+        missed = 0
+        for w in words:
+            if w in seen and w not in exact:
+                assert kind == 'bloom', (kind, w)
+                missed += 1
+            seen.add(w)
+            exact.add(w)
+            assert w in seen
+        assert len(seen) == len(exact) - missed, kind
+        if kind == 'set':
+            size = sys.getsizeof(seen) + sum([sys.getsizeof(w) for w in seen])
+        elif kind == 'compact':
+            size = seen.table.buffer_info()[1] * seen.table.itemsize
+        else:
+            size = sum([len(layer[0]) for layer in seen.layers])
+        print("%-8s %7d words, %5.1f bytes a word, %d false positives" %
+              (kind, len(seen), size / len(seen), missed))
@@ -25,13 +25,43 @@
 
 import random
 
+# NumPy is optional.  With it, selectors can pre-draw their picks in
+# large vectorized batches.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def numpy_rng(seed=None):
+    """A NumPy random Generator, for use as WeightedSelector's nprng."""
+    if numpy is None:
+        raise ImportError("NumPy is not installed")
+    return numpy.random.default_rng(seed)
+
 # When you are selecting from a pool a *lot*, this
 # will speed things up a bit.  Takes a dict of keys
 # and weights.
+#
+# Selection uses Vose's alias method: the tables are built once, in
+# linear time, and after that every draw is a single random number,
+# one list index and one comparison, no matter how many keys there
+# are.
+#
+# Random numbers come from rng, a random.Random instance (a private
+# one if none is given).  If a NumPy Generator is passed as nprng
+# instead, picks are drawn batch at a time in one vectorized call and
+# handed out one by one.
 class WeightedSelector(object):
 #    __slots__ = ['keys', 'weights', 'sum', 'n']
     
-    def __init__(self, dic):
+    def __init__(self, dic, rng=None, nprng=None, batch=1024):
+        if rng is None:
+            rng = random.Random()
+        self.rng = rng
+        self.nprng = nprng
+        self.batch = batch
+        self.pending = []
         # build parallel arrays for indexing
         self.keys = []
         self.weights = []
@@ -40,20 +70,102 @@ class WeightedSelector(object):
             self.weights.append(weight)
         self.sum = sum(self.weights)
         self.n = len(self.keys)
+        self.build_alias_tables()
+
+    def build_alias_tables(self):
+        """Vose's alias method.  Each of the n columns holds the
+        probability of keeping its own key and the index of the key
+        to take otherwise."""
+        n = self.n
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        if n == 0 or self.sum <= 0:
+            return
+        scaled = [w * n / self.sum for w in self.weights]
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # Whatever is left over is 1.0, give or take rounding error.
+        for i in large + small:
+            self.prob[i] = 1.0
+        if self.nprng is not None:
+            self.np_prob = numpy.array(self.prob)
+            self.np_alias = numpy.array(self.alias)
+
+    def reset(self):
+        """Throw away any pre-drawn picks, e.g. after reseeding."""
+        self.pending = []
 
     def select(self):
-        pick = random.uniform(0, self.sum)
-        tmp = 0
-        for i in range(self.n):
-            tmp += self.weights[i]
-            if pick < tmp:
-                return self.keys[i]
-        return 'woo!'
+        if self.nprng is not None:
+            if not self.pending:
+                self.pending = self.select_many(self.batch)
+            return self.pending.pop()
+        # One random number does both jobs: the integer part picks
+        # the column, the fractional part the coin flip within it.
+        u = self.rng.random() * self.n
+        i = int(u)
+        if u - i < self.prob[i]:
+            return self.keys[i]
+        return self.keys[self.alias[i]]
+
+    def select_many(self, k):
+        """Make k independent selections at once."""
+        if self.nprng is not None:
+            u = self.nprng.random(k) * self.n
+            i = u.astype(numpy.intp)
+            picks = numpy.where(u - i < self.np_prob[i], i, self.np_alias[i])
+            keys = self.keys
+            return [keys[j] for j in picks.tolist()]
+        n = self.n
+        keys = self.keys
+        prob = self.prob
+        alias = self.alias
+        rand = self.rng.random
+        picks = []
+        for u in [rand() * n for j in range(k)]:
+            i = int(u)
+            if u - i < prob[i]:
+                picks.append(keys[i])
+            else:
+                picks.append(keys[alias[i]])
+        return picks
 
     def __iter__(self):
         return iter(self.keys)
 
-#m = WeightedSelector({'a': 7, 'b': 5, 'c': 1})
-#for i in range(5000):
-#    if m.select() == 'c': print("c")
 
+# Testing...  Draws a good many samples and compares the observed
+# frequencies against the configured weights.
+if __name__ == '__main__':
+    weights = {'a': 7, 'b': 5, 'c': 1, 'd': 0.5, 'e': 12}
+    m = WeightedSelector(weights)
+    total = sum(weights.values())
+    draws = 200000
+    tests = [('select', [m.select() for i in range(draws)]),
+             ('select_many', m.select_many(draws))]
+    if numpy is not None:
+        m = WeightedSelector(weights, nprng=numpy_rng())
+        tests += [('numpy select', [m.select() for i in range(draws)]),
+                  ('numpy select_many', m.select_many(draws))]
+    for (label, picks) in tests:
+        counts = dict.fromkeys(weights, 0)
+        for p in picks:
+            counts[p] += 1
+        chi2 = 0.0
+        for key, weight in weights.items():
+            expected = draws * weight / total
+            chi2 += (counts[key] - expected) ** 2 / expected
+        # 18.47 is the 0.001 critical value at 4 degrees of freedom.
+        print("%s: chi-square %.2f (%s)" %
+              (label, chi2, "ok" if chi2 < 18.47 else "FAILED"))
+        assert chi2 < 18.47
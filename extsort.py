@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015-2016 William S. Annis
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Sorting word lists too big to hold in memory.
+
+The words are read a run at a time; each run is sorted in memory and
+written, with its sort keys, to a temporary file, and the runs are
+then merged.  sorted() is stable and heapq.merge() breaks ties in
+favor of earlier runs, so the result is exactly what sorted() would
+have given with the same key, ties included.
+"""
+
+import heapq
+import struct
+import tempfile
+
+
+# Words sorted in memory at a time.
+RUN_SIZE = 500000
+
+# How many runs are merged at once.  Whenever the last MERGE_WIDTH runs
+# are the same size they are merged into one, which keeps the number of
+# open files down to about MERGE_WIDTH per power of MERGE_WIDTH words.
+MERGE_WIDTH = 64
+
+# Each record in a run file: the lengths of the key and the word, then
+# the key (bytes) and the word (UTF-8).
+HEADER = struct.Struct('>II')
+
+
+def write_run(run, tmpdir):
+    f = tempfile.TemporaryFile(dir=tmpdir)
+    pack = HEADER.pack
+    for (key, word) in run:
+        word = word.encode('utf-8')
+        f.write(pack(len(key), len(word)))
+        f.write(key)
+        f.write(word)
+    f.seek(0)
+    return f
+
+
+def read_run(f):
+    read = f.read
+    size = HEADER.size
+    unpack = HEADER.unpack
+    try:
+        while True:
+            header = read(size)
+            if not header:
+                return
+            (klen, wlen) = unpack(header)
+            key = read(klen)
+            yield (key, read(wlen).decode('utf-8'))
+    finally:
+        f.close()
+
+
+def merge_runs(runs):
+    return heapq.merge(*[read_run(f) for (level, f) in runs],
+                       key=lambda r: r[0])
+
+
+def external_sort(words, key, run_size=RUN_SIZE, tmpdir=None,
+                  merge_width=MERGE_WIDTH):
+    """Yield words (any iterable) in the order sorted(words, key=key)
+    would give, holding at most run_size of them in memory.  key must
+    return bytes.  If everything fits in one run, no files are
+    written."""
+    runs = []
+    run = []
+    for word in words:
+        run.append((key(word), word))
+        if len(run) >= run_size:
+            run.sort(key=lambda r: r[0])
+            # Runs are (level, file), a level n run being made from
+            # merge_width**n sorted runs.
+            runs.append((0, write_run(run, tmpdir)))
+            run = []
+            while (len(runs) >= merge_width and
+                   runs[-merge_width][0] == runs[-1][0]):
+                # Merging neighbouring runs keeps ties in order.
+                level = runs[-1][0]
+                merged = write_run(merge_runs(runs[-merge_width:]), tmpdir)
+                runs[-merge_width:] = [(level + 1, merged)]
+    run.sort(key=lambda r: r[0])
+    if not runs:
+        for (k, word) in run:
+            yield word
+        return
+    if run:
+        runs.append((0, write_run(run, tmpdir)))
+    del run
+    for (k, word) in merge_runs(runs):
+        yield word
+
+
+# Testing...  Sorting the words of every example phonology on disk, in
+# tiny runs, has to give the same order as sorting them in memory.
+if __name__ == '__main__':
+    import glob
+    import os
+    from PhDefParser import PhonologyDefinition
+    from wordgen import SoundSystem
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    defs = [os.path.join(here, 'test.def')]
+    defs += sorted(glob.glob(os.path.join(here, 'examples', '*.def')))
+    for fname in defs:
+        # 'ignore' gives some different words the same key, which
+        # tests the handling of ties.
+        for unknown in ('last', 'ignore'):
+            ss = SoundSystem(1)
+            ss.unknown_letters = unknown
+            ss = PhonologyDefinition(ss, fname).soundsys
+            words = list(ss.iter_words(5000, unique=False))
+            if ss.sorter is not None:
+                key = ss.sorter.key
+                expected = ss.sorter(words)
+            else:
+                key = str.encode
+                expected = sorted(words)
+            for (run_size, width) in ((1, 2), (7, 3), (1000, 64),
+                                      (10000, 64)):
+                got = list(external_sort(iter(words), key, run_size,
+                                         merge_width=width))
+                assert got == expected, (fname, unknown, run_size)
+        print("%s: identical" % os.path.basename(fname))
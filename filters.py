@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015-2016 William S. Annis
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Filters and rejections, compiled once into a chain of stages.
+
+The meaning is always that of running each (pattern, replacement)
+pair through re.sub() in order and giving up as soon as 'REJECT'
+shows up in the word.  The chain only merges steps where that can't
+make a difference:
+
+    * A run of consecutive rejections becomes one alternation, since
+      rejections don't change the word and their order is irrelevant.
+    * A run of consecutive plain-text substitutions becomes a single
+      table-driven pass, as long as no step can see the text another
+      one touches: no two patterns may overlap, no later pattern may
+      share a character with an earlier replacement, and a deletion
+      (which joins the text either side of it) ends the run.
+"""
+
+import re
+
+
+# Stage types.
+REJECT, SUBSTITUTE, REPLACE, TRANSLATE, TABLE = range(5)
+
+# Characters with a special meaning in a regular expression.  A
+# pattern without any of them only ever matches itself.
+METACHARS = set('.^$*+?{}[]\\|()')
+
+BACKREF = re.compile(r'\\[1-9]|\(\?P=')
+
+
+def is_reject(pat, repl):
+    return repl == 'REJECT'
+
+def is_literal(pat, repl):
+    return (pat != '' and not (set(pat) & METACHARS)
+            and '\\' not in repl)
+
+# Could matches of two plain-text patterns ever overlap in a word?
+def overlaps(p, q):
+    if p in q or q in p:
+        return True
+    for i in range(1, min(len(p), len(q))):
+        if p[-i:] == q[:i] or q[-i:] == p[:i]:
+            return True
+    return False
+
+
+# The plain, one step at a time version.  This is the definition of
+# what a filter chain does.
+def apply_sequential(filters, word):
+    for (pat, repl) in filters:
+        word = re.sub(pat, repl, word)
+        if 'REJECT' in word:
+            return 'REJECT'
+    return word
+
+
+class FilterChain(object):
+    def __init__(self, filters, skip=()):
+        """Takes a list of (pattern, replacement) pairs, as kept in
+        SoundSystem.filters.  The filters whose indices are in skip
+        are left out; they must be rejections already known not to
+        match, since only then does leaving them out change nothing."""
+        self.filters = list(filters)
+        self.skip = set(skip)
+        # Each stage is (type, pattern, argument, index), where index
+        # is the position in filters of the stage's first filter.
+        self.stages = []
+        # After apply() rejects a word, the index of the filter that
+        # did it.  When a merged group of rejections matches, it's
+        # the one whose match starts earliest in the word.
+        self.rejected_by = None
+        # The filters compiled one by one, for apply_counted().
+        self.compiled = None
+        i = 0
+        n = len(self.filters)
+        while i < n:
+            if i in self.skip:
+                i += 1
+                continue
+            (pat, repl) = self.filters[i]
+            j = i + 1
+            if is_reject(pat, repl):
+                while j < n and is_reject(*self.filters[j]):
+                    j += 1
+                self.add_rejects(i, j)
+            elif is_literal(pat, repl):
+                pats = [pat]
+                seen_repls = set(repl)
+                while (j < n and is_literal(*self.filters[j])
+                       and self.filters[j - 1][1] != ''):
+                    (p2, r2) = self.filters[j]
+                    if set(p2) & seen_repls:
+                        break
+                    if any([overlaps(p2, p1) for p1 in pats]):
+                        break
+                    pats.append(p2)
+                    seen_repls |= set(r2)
+                    j += 1
+                self.add_literals(i, j)
+            else:
+                self.stages.append((SUBSTITUTE, re.compile(pat), repl, i))
+            i = j
+
+    def add_rejects(self, start, end):
+        # In the merged pattern each rejection gets a named group, so
+        # a match tells us which one it was.
+        merge = []
+        for i in range(start, end):
+            if i in self.skip:
+                continue
+            pat = self.filters[i][0]
+            if BACKREF.search(pat):
+                # Group numbers would shift inside an alternation.
+                self.stages.append((REJECT, re.compile(pat), None, i))
+            else:
+                merge.append(i)
+        if not merge:
+            return
+        alts = ["(?P<f%d>%s)" % (i, self.filters[i][0]) for i in merge]
+        try:
+            combined = re.compile("|".join(alts))
+        except re.error:
+            # Something (named groups, inline flags) won't combine.
+            for i in merge:
+                self.stages.append((REJECT, re.compile(self.filters[i][0]),
+                                    None, i))
+            return
+        self.stages.append((REJECT, combined, True, merge[0]))
+
+    def add_literals(self, start, end):
+        group = self.filters[start:end]
+        table = dict(group)
+        if len(group) == 1:
+            (pat, repl) = group[0]
+            self.stages.append((REPLACE, pat, repl, start))
+        elif all([len(pat) == 1 for pat in table]):
+            self.stages.append((TRANSLATE, str.maketrans(table), None, start))
+        else:
+            keys = sorted(table, key=len, reverse=True)
+            pattern = re.compile("|".join([re.escape(k) for k in keys]))
+            self.stages.append((TABLE, pattern, table, start))
+
+    def apply(self, word):
+        for (kind, a, b, index) in self.stages:
+            if kind == REJECT:
+                m = a.search(word)
+                if m:
+                    if b:
+                        index = int(m.lastgroup[1:])
+                    self.rejected_by = index
+                    return 'REJECT'
+                continue
+            elif kind == REPLACE:
+                word = word.replace(a, b)
+            elif kind == TRANSLATE:
+                word = word.translate(a)
+            elif kind == TABLE:
+                word = a.sub(lambda m: b[m.group()], word)
+            else:
+                word = a.sub(b, word)
+            if 'REJECT' in word:
+                self.rejected_by = index
+                return 'REJECT'
+        return word
+
+    def apply_counted(self, word, hits):
+        """Like apply(), but running the filters one at a time, so
+        that it can count in hits (a dict of filter index -> count)
+        each filter that changed or rejected the word.  Slower; for
+        profiling."""
+        if self.compiled is None:
+            self.compiled = [None if i in self.skip else re.compile(pat)
+                             for (i, (pat, repl)) in enumerate(self.filters)]
+        for (i, pat) in enumerate(self.compiled):
+            if pat is None:
+                continue
+            (word, count) = pat.subn(self.filters[i][1], word)
+            if count:
+                hits[i] = hits.get(i, 0) + 1
+            if 'REJECT' in word:
+                self.rejected_by = i
+                return 'REJECT'
+        return word
+
+
+# Testing...  Checks that the compiled chain gives exactly the same
+# results as applying the filters one by one, for every example
+# phonology shipped with Lexifer.
+if __name__ == '__main__':
+    import glob
+    import os
+    from PhDefParser import PhonologyDefinition
+    from wordgen import SoundSystem
+
+    # A deletion can join text into a match for a later filter.
+    tricky = [('x', ''), ('ab', 'Q')]
+    assert FilterChain(tricky).apply('axb') == 'Q'
+    assert apply_sequential(tricky, 'axb') == 'Q'
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    defs = [os.path.join(here, 'test.def')]
+    defs += sorted(glob.glob(os.path.join(here, 'examples', '*.def')))
+    for fname in defs:
+        pd = PhonologyDefinition(SoundSystem(1), fname)
+        ss = pd.soundsys
+        chain = FilterChain(ss.filters)
+        checked = 0
+        for i in range(20000):
+            word = ss.run_rule(ss.select_rule())
+            if ss.sorter:
+                w = ss.sorter.split(word)
+                if ss.use_assim:
+                    w = ss.features.apply_assimilations(w)
+                if ss.use_coronal_metathesis:
+                    w = ss.features.apply_coronal_metathesis(w)
+                word = "".join(w)
+            expected = apply_sequential(ss.filters, word)
+            got = chain.apply(word)
+            assert got == expected, (fname, word, expected, got)
+            assert chain.apply_counted(word, {}) == expected
+            if got == 'REJECT':
+                # The filter blamed has to reject the word as it
+                # stands when its stage is reached.  (Within a group
+                # of rejections the one matching earliest in the word
+                # gets the blame.)
+                i = chain.rejected_by
+                start = max([st[3] for st in chain.stages if st[3] <= i])
+                before = apply_sequential(ss.filters[:start], word)
+                assert before != 'REJECT', (fname, word, i)
+                assert apply_sequential([ss.filters[i]], before) == 'REJECT'
+            checked += 1
+        print("%s: %d filters in %d stages, %d words identical" %
+              (os.path.basename(fname), len(ss.filters), len(chain.stages),
+               checked))
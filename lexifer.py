@@ -27,10 +27,16 @@
 """
 
 import argparse
-import textwrap
+import os
+import sys
 from sys import stderr
-from PhDefParser import PhonologyDefinition
-from wordgen import SoundSystem, textify
+from PhDefParser import PhonologyDefinition, ParseError, load_definition
+from wordgen import SoundSystem, GenerationError, UnknownLetterError, iter_text
+from wordgen import zipf_words, wrap_lines, read_words
+from dedup import KINDS as DEDUP_KINDS
+from extsort import RUN_SIZE
+from wordgen import UNKNOWN_POLICIES
+import server
 
 # There is some whinging about regular expressions in 3 that I will
 # deal with at some other time.
@@ -38,39 +44,297 @@ import warnings
 warnings.simplefilter("ignore")
 
 
+def positive_int(text):
+    try:
+        n = int(text)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError("not a positive whole number: '%s'"
+                                         % text)
+    return n
+
+
 # Deal with arguments.
 opt = argparse.ArgumentParser()
-opt.add_argument("file", help="phonology definition file")
+opt.add_argument("file", help="phonology definition file", nargs='?')
 opt.add_argument("-n", "--number", help="how many words to generate", type=int)
 opt.add_argument("-u", "--unsorted", help="print out words unsorted",
                  action="store_true")
 opt.add_argument("-o", "--one-per-line", help="print one word per line",
                  action="store_true")
-args = opt.parse_args()
-
-# And off we go!  Parse the definition file.
-pd = PhonologyDefinition(SoundSystem(), args.file)
-
-# Hack to make print stop whining about encodings.
-utf8stdout = open(1, 'w', encoding='utf-8', closefd=False)
-
-# Generate some words...
-if args.number is None:
-    # Default behavior - print out a paragraph of text.
-    if args.unsorted:
-        stderr.write("** 'Unsorted' option ignored in paragraph mode.\n\n")
-    if args.one_per_line:
-        stderr.write("** 'One per line' option ignored in paragraph mode.\n\n")
-    print(textify(pd.soundsys, 25), file=utf8stdout)
-else:
-    # Just a wordlist.
-    words = pd.generate(args.number, args.unsorted)
-    if args.one_per_line:
+opt.add_argument("-s", "--stream",
+                 help="print unsorted words, one per line, as they are made "
+                      "(forever, unless -n is given)",
+                 action="store_true")
+opt.add_argument("-d", "--duplicates",
+                 help="allow repeated words in --stream output",
+                 action="store_true")
+opt.add_argument("-a", "--all",
+                 help="list every word the phonology can make (with -n, a "
+                      "weighted sample of that many of them)",
+                 action="store_true")
+opt.add_argument("-p", "--partial",
+                 help="if the phonology can't make enough words, print "
+                      "those it can instead of stopping with an error",
+                 action="store_true")
+opt.add_argument("--extend",
+                 help="add -n new words, none already in this word list, and "
+                      "print the whole list sorted (with -u, just the new "
+                      "words)",
+                 metavar="FILE")
+opt.add_argument("--external-sort",
+                 help="sort word lists too big for memory on disk",
+                 action="store_true")
+opt.add_argument("--run-size",
+                 help="with --external-sort, how many words to hold in "
+                      "memory at a time (default: %(default)s)",
+                 metavar="N", type=positive_int, default=RUN_SIZE)
+opt.add_argument("--dedup",
+                 help="how to remember the words already made: 'compact' "
+                      "and 'bloom' use far less memory than the default on "
+                      "huge runs, 'bloom' at the cost of skipping an "
+                      "occasional new word",
+                 choices=DEDUP_KINDS, default='set')
+opt.add_argument("--constrained",
+                 help="draw phonemes so as to steer clear of the rejections, "
+                      "rather than throwing rejected words away (faster "
+                      "with many rejections; word frequencies differ "
+                      "slightly)",
+                 action="store_true")
+opt.add_argument("--unknown-letters",
+                 help="what to do when sorting meets a letter missing from "
+                      "'letters:' (default: error)",
+                 choices=UNKNOWN_POLICIES, default='error')
+opt.add_argument("-c", "--cache",
+                 help="keep a compiled copy of the definition file, so "
+                      "later runs can skip parsing it",
+                 action="store_true")
+opt.add_argument("--seed", help="random seed, to make a run repeatable",
+                 type=int)
+opt.add_argument("-j", "--jobs",
+                 help="generate word lists with this many processes",
+                 type=int, default=1)
+opt.add_argument("--sentences",
+                 help="how many sentences of text to make when not making a "
+                      "word list (default: 25)",
+                 type=int, default=25)
+opt.add_argument("--lexicon",
+                 help="make text from a vocabulary of this many words, used "
+                      "with realistic (Zipfian) frequencies, rather than "
+                      "new words throughout",
+                 type=int)
+opt.add_argument("--output",
+                 help="write to this file instead of standard output")
+opt.add_argument("--stats",
+                 help="when done, report where the time went and what the "
+                      "filters did (on standard error)",
+                 action="store_true")
+opt.add_argument("--serve",
+                 help="answer JSON requests, one per line, on standard input "
+                      "(see server.py)",
+                 action="store_true")
+opt.add_argument("--socket",
+                 help="like --serve, but listen on this Unix socket instead")
+opt.add_argument("--pool-size",
+                 help="how many phonologies to keep loaded when serving "
+                      "(default: 16)",
+                 type=int, default=16)
+
+# How many words to write between flushes in --stream mode.
+FLUSH_EVERY = 1000
+
+
+def main():
+    args = opt.parse_args()
+
+    if args.serve or args.socket:
+        serve(args)
+        return
+    if args.file is None:
+        opt.error("the following arguments are required: file")
+    if args.extend and args.number is None:
+        opt.error("--extend needs -n, the number of words to add")
+    if args.extend and (args.all or args.stream):
+        opt.error("--extend can't be used with --%s"
+                  % ('all' if args.all else 'stream'))
+
+    # And off we go!  Parse the definition file.
+    try:
+        if args.cache:
+            pd = load_definition(args.file, args.seed, args.unknown_letters)
+        else:
+            soundsys = SoundSystem(args.seed)
+            soundsys.unknown_letters = args.unknown_letters
+            pd = PhonologyDefinition(soundsys, args.file)
+    except ParseError as e:
+        stderr.write("** %s\n" % e)
+        sys.exit(1)
+    pd.soundsys.profile = args.stats
+    pd.soundsys.dedup = args.dedup
+    pd.soundsys.constrained = args.constrained
+
+    # When extending a word list in place, the old list has to be read
+    # while the new one is written, so write a copy and swap it in.
+    new_output = None
+    if (args.output and args.extend and os.path.exists(args.output) and
+            os.path.samefile(args.output, args.extend)):
+        new_output = args.output + '.new'
+
+    # Hack to make print stop whining about encodings.
+    if new_output:
+        utf8stdout = open(new_output, 'w', encoding='utf-8')
+    elif args.output:
+        utf8stdout = open(args.output, 'w', encoding='utf-8')
+    else:
+        utf8stdout = open(1, 'w', encoding='utf-8', closefd=False)
+
+    # Generate some words...
+    if args.all:
+        if args.stats:
+            stderr.write("** 'Stats' option ignored with --all.\n\n")
+        try:
+            words = pd.generate_all(args.number, args.unsorted)
+        except (GenerationError, UnknownLetterError) as e:
+            stderr.write("** %s\n" % e)
+            sys.exit(1)
+        print_words(words, args.one_per_line, utf8stdout)
+    elif args.stream:
+        if args.jobs > 1:
+            stderr.write("** 'Jobs' option ignored in stream mode.\n\n")
+        words = pd.iter_words(args.number, not args.duplicates,
+                              partial=args.partial)
+        write_lines(words, utf8stdout)
+        print_stats(args, pd.soundsys)
+    elif args.number is None:
+        # Default behavior - print out a paragraph of text.
+        if args.unsorted:
+            stderr.write("** 'Unsorted' option ignored in paragraph mode.\n\n")
+        if args.one_per_line:
+            stderr.write("** 'One per line' option ignored in paragraph mode.\n\n")
+        if args.stats:
+            stderr.write("** 'Stats' option ignored in paragraph mode.\n\n")
+        words = None
+        if args.lexicon:
+            try:
+                words = zipf_words(pd.soundsys, args.lexicon,
+                                   partial=args.partial)
+            except (GenerationError, UnknownLetterError) as e:
+                stderr.write("** %s\n" % e)
+                sys.exit(1)
+        write_lines(iter_text(pd.soundsys, args.sentences, words=words),
+                    utf8stdout)
+    elif args.extend:
+        # New words for an existing word list.
+        if args.jobs > 1:
+            stderr.write("** 'Jobs' option ignored with --extend.\n\n")
+        soundsys = pd.soundsys
+        try:
+            (old, ordered) = soundsys.load_words(read_words(args.extend))
+            words = list(soundsys.iter_words(args.number, partial=args.partial,
+                                             exclude=old))
+            del old
+            if not args.unsorted:
+                words.sort(key=soundsys.sort_key())
+                words = soundsys.merge_sorted(read_words(args.extend), words,
+                                              ordered)
+            print_words(words, args.one_per_line, utf8stdout)
+        except (GenerationError, UnknownLetterError) as e:
+            utf8stdout.close()
+            if new_output:
+                os.remove(new_output)
+            stderr.write("** %s\n" % e)
+            sys.exit(1)
+        if new_output:
+            utf8stdout.close()
+            os.replace(new_output, args.output)
+        print_stats(args, pd.soundsys)
+    elif args.external_sort:
+        # A wordlist too big to sort in memory.  The words are made,
+        # sorted and printed a few at a time, so errors can turn up
+        # part way through the output.
+        if args.jobs > 1:
+            stderr.write("** 'Jobs' option ignored with --external-sort.\n\n")
+        try:
+            words = pd.iter_words(args.number, partial=args.partial)
+            if not args.unsorted:
+                words = pd.soundsys.iter_sorted(words, args.run_size)
+            print_words(words, args.one_per_line, utf8stdout)
+        except (GenerationError, UnknownLetterError) as e:
+            utf8stdout.flush()
+            stderr.write("** %s\n" % e)
+            sys.exit(1)
+        print_stats(args, pd.soundsys)
+    else:
+        # Just a wordlist.
+        try:
+            words = pd.generate(args.number, args.unsorted,
+                                workers=args.jobs, partial=args.partial)
+        except (GenerationError, UnknownLetterError) as e:
+            stderr.write("** %s\n" % e)
+            sys.exit(1)
+        print_words(words, args.one_per_line, utf8stdout)
+        print_stats(args, pd.soundsys)
+
+
+def write_lines(lines, out):
+    """Write lines out as they are made."""
+    try:
+        count = 0
+        for line in lines:
+            out.write(line + "\n")
+            count += 1
+            if count % FLUSH_EVERY == 0:
+                out.flush()
+        out.flush()
+    except BrokenPipeError:
+        # The reader went away (e.g. piped into 'head').  Point stdout
+        # at /dev/null so the final flush at exit doesn't complain.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    except KeyboardInterrupt:
+        out.flush()
+    except GenerationError as e:
+        out.flush()
+        stderr.write("** %s\n" % e)
+        sys.exit(1)
+
+
+def print_stats(args, soundsys):
+    if args.stats:
+        stderr.write(soundsys.stats.report(soundsys.filters) + "\n")
+
+
+def serve(args):
+    pool = server.PhonologyPool(args.pool_size, args.unknown_letters)
+    try:
+        if args.socket:
+            server.serve_unix(pool, args.socket)
+        else:
+            utf8stdin = open(0, 'r', encoding='utf-8', closefd=False)
+            utf8stdout = open(1, 'w', encoding='utf-8', closefd=False)
+            server.serve_stream(pool, utf8stdin, utf8stdout)
+    except KeyboardInterrupt:
+        pass
+
+
+def print_words(words, one_per_line, out):
+    if one_per_line:
         for w in words:
-            print(w, file=utf8stdout)
+            print(w, file=out)
     else:
-        words = textwrap.wrap(" ".join(words), 70)
-        print("\n".join(words), file=utf8stdout)
-    
+        # Line by line, so that words can be an iterator too long to
+        # join into one string.
+        empty = True
+        for line in wrap_lines(words, 70):
+            print(line, file=out)
+            empty = False
+        if empty:
+            print(file=out)
+
+
+# The work is done in main() so that worker processes started with
+# --jobs can import this file without running it.
+if __name__ == '__main__':
+    main()
 
 # EOF
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2015-2016 William S. Annis
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A long-running Lexifer, for programs that would otherwise start a new
+one for every handful of words.
+
+Requests and responses are JSON objects, one per line.  A request
+names a definition file and says what it wants from it:
+
+    {"file": "examples/laadan.def", "n": 20, "seed": 5}
+
+Optional fields are "unsorted", "partial" and "all" (as the command
+line options), "sentences" (a paragraph of that many sentences instead
+of a word list) and "id", which is copied into the response.  The
+answer is {"words": [...]}, {"text": "..."} or {"error": "..."}.
+
+Parsed definitions are kept in memory, the least recently used being
+dropped once there are too many; a file that changes on disk is read
+again.  Every phonology is parsed with the same fixed seed, so a given
+file, seed and request always get the same answer, even after a
+restart.  (Not the same words as 'lexifer --seed', which seeds the
+parsing too.)
+"""
+
+import collections
+import json
+import os
+import socketserver
+import threading
+from PhDefParser import PhonologyDefinition
+from wordgen import SoundSystem, textify
+
+# The seed every phonology is parsed with.
+PARSE_SEED = 0
+
+
+class PhonologyPool(object):
+    def __init__(self, size=16, unknown_letters='error'):
+        self.size = size
+        self.unknown_letters = unknown_letters
+        # path -> ((mtime, size), PhonologyDefinition), oldest first
+        self.pool = collections.OrderedDict()
+
+    def get(self, fname):
+        path = os.path.abspath(fname)
+        st = os.stat(path)
+        stamp = (st.st_mtime_ns, st.st_size)
+        entry = self.pool.get(path)
+        if entry is not None and entry[0] == stamp:
+            self.pool.move_to_end(path)
+            return entry[1]
+        soundsys = SoundSystem(PARSE_SEED)
+        soundsys.unknown_letters = self.unknown_letters
+        pd = PhonologyDefinition(soundsys, path)
+        self.pool[path] = (stamp, pd)
+        self.pool.move_to_end(path)
+        while len(self.pool) > self.size:
+            self.pool.popitem(last=False)
+        return pd
+
+    def handle(self, request):
+        """Answer one request (a dict), returning the response dict."""
+        soundsys = self.get(request['file']).soundsys
+        soundsys.seed(request.get('seed'))
+        if 'sentences' in request:
+            return {'text': textify(soundsys, int(request['sentences']))}
+        n = request.get('n')
+        if n is not None:
+            n = int(n)
+        unsorted = bool(request.get('unsorted'))
+        if request.get('all'):
+            words = soundsys.generate_all(n, unsorted)
+        else:
+            words = soundsys.generate(10 if n is None else n, unsorted,
+                                      partial=bool(request.get('partial')))
+        return {'words': words}
+
+    def respond(self, line):
+        """Turn one line of JSON request into one line of JSON reply."""
+        request = {}
+        try:
+            request = json.loads(line)
+            response = self.handle(request)
+        except Exception as e:
+            response = {'error': str(e) or e.__class__.__name__}
+        if isinstance(request, dict) and 'id' in request:
+            response['id'] = request['id']
+        return json.dumps(response, ensure_ascii=False)
+
+
+def serve_stream(pool, infile, outfile):
+    """Answer requests read from infile until it runs out."""
+    for line in infile:
+        if line.strip() == '':
+            continue
+        outfile.write(pool.respond(line) + "\n")
+        outfile.flush()
+
+
+def serve_unix(pool, path):
+    """Answer requests on a Unix domain socket, each connection in a
+    thread of its own.  The phonologies in the pool aren't safe to
+    share between threads, so only one request is worked on at a
+    time, but a client that keeps its connection open doesn't hold
+    up the others."""
+    lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                line = line.decode('utf-8')
+                if line.strip() == '':
+                    continue
+                with lock:
+                    reply = pool.respond(line) + "\n"
+                self.wfile.write(reply.encode('utf-8'))
+                self.wfile.flush()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+        # Don't wait for idle clients to hang up before exiting.
+        server.daemon_threads = True
+        try:
+            server.serve_forever()
+        finally:
+            os.unlink(path)
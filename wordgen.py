@@ -23,29 +23,91 @@
 # SOFTWARE.
 
 
-from distribution import WeightedSelector
+from distribution import WeightedSelector, numpy_rng
+from filters import FilterChain
+from dedup import new_seen
+from extsort import external_sort, RUN_SIZE
+from constrained import ConstrainedSampler
+from opcodes import LITERAL, CLASS, OPTIONAL, NOREPEAT
+from array import array
+import asyncio
 import random
 import re
 import math
 import SmartClusters as sc
 import codecs
 import textwrap
+import multiprocessing
+import heapq
+import itertools
 import sys
+import time
 
 
 class RuleError(Exception): pass
 
+class GenerationError(Exception): pass
+
+class UnknownLetterError(Exception):
+    def __init__(self, word):
+        Exception.__init__(self, word)
+        self.word = word
+
+    def __str__(self):
+        return ("Word with unknown letter: '%s'.\n"
+                "A filter or assimilation might have caused this." % self.word)
+
+
+# How many candidate words in a row may fail (rejected or already
+# seen) before generation decides the phonology is used up.
+PATIENCE = 100000
+
+# What ArbSorter can do about letters missing from its sort order.
+UNKNOWN_POLICIES = ('error', 'last', 'ignore')
+
+# How many words ArbSorter remembers the letters of.
+SPLIT_CACHE_SIZE = 100000
+
+# How many raw words a FilterCache remembers the filtered form of.
+FILTER_CACHE_SIZE = 100000
+
+# Exponent of the Zipf distribution of words in lexicon text: the word
+# of rank r turns up in proportion to 1 / r**ZIPF_EXPONENT.
+ZIPF_EXPONENT = 1.0
+
+# Don't try to list every word of a phonology bigger than this.
+ENUMERATION_LIMIT = 10**7
+
+# How long, in seconds, the async API works before giving the event
+# loop a turn.
+ASYNC_SLICE = 0.01
+
 
 # Define an arbitrary sort order, in unicode and possibly including
-# di- or n-graphs.  It ain't efficient, but it works.
+# di- or n-graphs.
+#
+# Words are cut into letters by a longest-match tokenizer (a regex
+# alternation with the longest letters first, falling back to any
+# single character), and sorted on compact byte-string keys: one byte
+# per letter, or two once there are 255 or more letters, big-endian,
+# so that comparing keys compares letter positions.
+#
+# What happens to characters not in the sort order depends on
+# 'unknown': 'error' raises UnknownLetterError, 'last' sorts them
+# after all the known letters (in code point order), 'ignore' leaves
+# them out of the key.
 class ArbSorter:
-    def __init__(self, order):
-        self.graphs = re.split('\s*', order, flags=re.UNICODE)
+    def __init__(self, order, unknown='error'):
+        if unknown not in UNKNOWN_POLICIES:
+            raise ValueError("Unknown letter policy must be one of: %s"
+                             % ", ".join(UNKNOWN_POLICIES))
+        self.unknown = unknown
+        self.graphs = order.split()
         # Create a regex to split on each character or multicharacter
         # sort key.  (As in "ch" after all "c"s, for example.)
         split_order = sorted(self.graphs, key=len, reverse=True)
-        split_order.append(".")
-        self.splitter = re.compile("(%s)" % "|".join(split_order), re.UNICODE)
+        split_order = [re.escape(g) for g in split_order] + ["."]
+        self.splitter = re.compile("|".join(split_order), re.UNICODE)
         # Next, collect ints for the ordering and the lookup
         # for putting words back together.
         self.ords = {}
@@ -53,60 +115,353 @@ class ArbSorter:
         for i in range(len(self.graphs)):
             self.ords[self.graphs[i]] = i
             self.vals.append(self.graphs[i])
+        self.width = 1 if len(self.graphs) < 255 else 2
+        self.codes = {}
+        for (g, i) in self.ords.items():
+            self.codes[g] = i.to_bytes(self.width, 'big')
+        # Marks an unknown letter in a key; the letter follows in
+        # UTF-8, which never contains a 0xff byte.
+        self.escape = b'\xff' * self.width
+        self.cache = {}
+
+    # The cache is just an optimization; don't drag it along when
+    # the sorter is pickled.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['cache'] = {}
+        return state
+
+    def split(self, word):
+        letters = self.cache.get(word)
+        if letters is None:
+            if len(self.cache) >= SPLIT_CACHE_SIZE:
+                self.cache.clear()
+            letters = self.cache[word] = self.splitter.findall(word)
+        return list(letters)
+
+    def key(self, word):
+        """The sort key for a word."""
+        # Words being sorted are all different, so there's no point
+        # going through the cache here.
+        codes = self.codes
+        try:
+            return b"".join([codes[g] for g in self.splitter.findall(word)])
+        except KeyError:
+            pass
+        if self.unknown == 'error':
+            raise UnknownLetterError(word)
+        key = []
+        for g in self.split(word):
+            if g in codes:
+                key.append(codes[g])
+            elif self.unknown == 'last':
+                key.append(self.escape + g.encode('utf-8'))
+        return b"".join(key)
 
     # Turns a word into a list of ints representing the new
-    # lexicographic ordering.  Python, helpfully, allows one to
-    # sort ordered collections of all types, including lists.
+    # lexicographic ordering.
     def word_as_values(self, word):
-        w = self.splitter.split(word)[1::2]
         try:
-            arrayed_word = [self.ords[char] for char in w]
+            return [self.ords[char] for char in self.split(word)]
         except KeyError:
-            msg = "Word with unknown letter: '%s'." % word
-            utf8stdout = open(1, 'w', encoding='utf-8', closefd=False)
-            print(msg, file=utf8stdout)
-            print("A filter or assimilation might have caused this.")
-            sys.exit(1)
-        return arrayed_word
+            raise UnknownLetterError(word)
 
     def values_as_word(self, values):
         return "".join([self.vals[v] for v in values])
 
-    def split(self, word):
-        return self.splitter.split(word)[1::2]
-
     def __call__(self, l):
-        l2 = [self.word_as_values(item) for item in l]
-        l2.sort()
-        return [self.values_as_word(item) for item in l2]
+        return sorted(l, key=self.key)
+
+    def prefixes(self):
+        """Every string a letter could turn out to be only the start
+        of, once more letters follow."""
+        found = set()
+        for g in self.graphs:
+            for i in range(1, len(g)):
+                found.add(g[:i])
+        return found
+
+
+# Words as lists of small ints, one per letter, rather than strings.
+# Then drawing a word, assimilation and metathesis never have to split
+# it up again, and if the filters leave it alone, its sort key is just
+# the ints packed into bytes.  The letters are numbered as in the sort
+# order, and anything else that turns up (letters missing from the
+# order, the results of assimilation) after them.
+#
+# This only works if joining the letters of a word together and
+# splitting them up again, as ArbSorter does, gives back the same
+# letters.  If the sort order has 't' and 'ts', say, a 't' followed by
+# an 's' would come back as 'ts', so such phonologies stay with
+# strings: see SoundSystem.phoneme_coder().
+class PhonemeCoder(object):
+    def __init__(self, soundsys):
+        self.soundsys = soundsys
+        sorter = soundsys.sorter
+        self.vals = list(sorter.vals)
+        self.index = dict(sorter.ords)
+        self.width = sorter.width
+        prefixes = sorter.prefixes()
+        # The letters of each phoneme the rules can draw.
+        self.tokens = {}
+        for plan in soundsys.plans.values():
+            for (op, arg) in plan:
+                for ph in ([arg] if op == LITERAL else arg.keys):
+                    if ph not in self.tokens:
+                        self.tokens[ph] = tuple(
+                            [self.code(g) for g in sorter.splitter.findall(ph)])
+        self.stable = True
+        for ph in self.tokens:
+            pos = 0
+            for i in self.tokens[ph]:
+                if ph[pos:] in prefixes:
+                    self.stable = False
+                pos += len(self.vals[i])
+        drawn = set([i for ids in self.tokens.values() for i in ids])
+        features = soundsys.features
+        # Pairs are looked up as one int, (first << 16) | second.
+        self.assim = {}
+        if soundsys.use_assim:
+            for a in drawn:
+                for b in drawn:
+                    new = features.assimilate(self.vals[a], self.vals[b])
+                    if new != self.vals[a]:
+                        self.assim[a << 16 | b] = self.code(new)
+        self.metathesis = {}
+        if soundsys.use_coronal_metathesis:
+            letters = drawn | set(self.assim.values())
+            for a in letters:
+                for b in letters:
+                    (x, y) = features.metathesize(self.vals[a], self.vals[b])
+                    if (x, y) != (self.vals[a], self.vals[b]):
+                        self.metathesis[a << 16 | b] = (self.code(x),
+                                                        self.code(y))
+        # A word can only be given its key from the numbers if every
+        # letter in it is in the sort order and splits off alone.
+        self.unkeyable = set([i for i in range(len(self.vals))
+                              if i >= len(sorter.vals) or
+                              self.vals[i] in prefixes])
+
+    def code(self, letter):
+        i = self.index.get(letter)
+        if i is None:
+            i = self.index[letter] = len(self.vals)
+            self.vals.append(letter)
+        return i
+
+    def assimilate(self, ids):
+        """FeatureDB.apply_assimilations() on letter numbers."""
+        get = self.assim.get
+        return [get(a << 16 | b, a) for (a, b) in zip(ids, ids[1:])] + ids[-1:]
+
+    def metathesize(self, ids):
+        """FeatureDB.apply_coronal_metathesis() on letter numbers."""
+        new = ids[:]
+        table = self.metathesis
+        for i in range(len(ids) - 1):
+            pair = table.get(ids[i] << 16 | ids[i+1])
+            if pair is None:
+                new[i] = ids[i]
+                new[i+1] = ids[i+1]
+            else:
+                (new[i], new[i+1]) = pair
+        return new
+
+    def word(self, ids):
+        return "".join([self.vals[i] for i in ids])
+
+    def key(self, ids):
+        """The sort key ArbSorter.key() would give the word, as bytes,
+        or None if the word has letters that rule this out."""
+        if not self.unkeyable.isdisjoint(ids):
+            return None
+        if self.width == 1:
+            return bytes(ids)
+        a = array('H', ids)
+        if sys.byteorder == 'little':
+            a.byteswap()
+        return a.tobytes()
+
+    def make_word(self, rule, chain):
+        """Draw a word from the rule, assimilate and filter it.  Returns
+        the word (or 'REJECT') and its sort key, if it comes free."""
+        soundsys = self.soundsys
+        plan = soundsys.plans.get(rule)
+        if plan is None:
+            plan = soundsys.plans[rule] = soundsys.compile_rule(rule)
+        phonemes = soundsys.run_plan(plan)
+        raw = "".join(phonemes)
+        cache = soundsys.filter_cache
+        found = cache.get(raw)
+        if found is not None:
+            (word, rejected_by, key) = found
+            if word == 'REJECT':
+                chain.rejected_by = rejected_by
+            return (word, key)
+        ids = []
+        tokens = self.tokens
+        for ph in phonemes:
+            ids += tokens[ph]
+        if self.assim:
+            ids = self.assimilate(ids)
+        if self.metathesis:
+            ids = self.metathesize(ids)
+        word = self.word(ids)
+        filtered = chain.apply(word)
+        if filtered != word:
+            rejected_by = chain.rejected_by if filtered == 'REJECT' else None
+            cache.put(raw, (filtered, rejected_by, None))
+            return (filtered, None)
+        key = self.key(ids)
+        cache.put(raw, (word, None, key))
+        return (word, key)
+
+
+class FilterCache(object):
+    """What SoundSystem.apply_filters() made of recent raw words,
+    'REJECT' included, since the rules keep drawing the same ones.
+    Each entry is (result, index of the rejecting filter, sort key if
+    known).  Like ArbSorter's cache, it is emptied when full.  hits
+    and misses count the lookups since it was made."""
+    def __init__(self, size=FILTER_CACHE_SIZE):
+        self.size = size
+        self.results = {}
+        self.hits = 0
+        self.misses = 0
+
+    # As with ArbSorter, no point pickling the cache itself.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['results'] = {}
+        return state
+
+    def get(self, word):
+        found = self.results.get(word)
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return found
 
+    def put(self, word, result):
+        if len(self.results) >= self.size:
+            self.results.clear()
+        self.results[word] = result
+
+    def clear(self):
+        """Forget every result; the filters or letters changed."""
+        self.results.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def __len__(self):
+        return len(self.results)
 
-# Weighted random selection.
-def select(dic):
-    total = sum(dic.values())
-    pick = random.uniform(0, total-1)
-    tmp = 0
-    for key, weight in dic.items():
-        tmp += weight
-        if pick < tmp:
-            return key
 
 # Give approximately natural frequencies to phonemes.
 # Gusein-Zade law.
-def jitter(v, percent=10.0):
+def jitter(v, percent=10.0, rng=random):
     move = v * (percent / 100.0)
-    return v + (random.random() * move) - (move / 2)
+    return v + (rng.random() * move) - (move / 2)
 
 # Takes a whitespace delimited string, returns a string
 # in the form expected by SoundSystem.add_ph_unit().
-def natural_weights(phonemes):
+def natural_weights(phonemes, rng=random):
     p = phonemes.split()
     n = len(p)
     weighted = {}
     for i in range(n):
-        weighted[p[i]] = jitter((math.log(n + 1) - math.log(i + 1)) / n)
+        weighted[p[i]] = jitter((math.log(n + 1) - math.log(i + 1)) / n,
+                                rng=rng)
     return ' '.join(['%s:%.2f' % (p, v) for (p, v) in list(weighted.items())])
 
+class GenerationStats(object):
+    """Counts of what happened while generating words."""
+    def __init__(self):
+        self.attempts = 0      # candidate words built
+        self.words = 0         # words kept
+        self.rejected = 0      # candidates thrown out by a filter
+        self.duplicates = 0    # candidates already generated
+        self.dead_ends = 0     # constrained draws with nowhere to go
+        self.rejects = {}      # filter index -> words it rejected
+        # Only counted when the sound system's profile flag is on:
+        self.hits = {}         # filter index -> words it changed
+        self.retries = 0       # redraws to avoid a '!' duplicate
+        self.times = {}        # stage -> seconds spent in it
+
+    def yield_rate(self):
+        """Fraction of candidates that became new words."""
+        if self.attempts == 0:
+            return 0.0
+        return self.words / self.attempts
+
+    def duplicate_rate(self):
+        """Fraction of candidates that were already generated."""
+        if self.attempts == 0:
+            return 0.0
+        return self.duplicates / self.attempts
+
+    def merge(self, other):
+        self.attempts += other.attempts
+        self.words += other.words
+        self.rejected += other.rejected
+        self.duplicates += other.duplicates
+        self.dead_ends += other.dead_ends
+        for (i, count) in other.rejects.items():
+            self.rejects[i] = self.rejects.get(i, 0) + count
+        for (i, count) in other.hits.items():
+            self.hits[i] = self.hits.get(i, 0) + count
+        self.retries += other.retries
+        for (stage, secs) in other.times.items():
+            self.times[stage] = self.times.get(stage, 0.0) + secs
+
+    def report(self, filters):
+        """A readable summary; filters is the list the indices in
+        self.rejects refer to."""
+        lines = ["attempts: %d" % self.attempts,
+                 "words: %d (yield %.1f%%)" % (self.words,
+                                              100 * self.yield_rate()),
+                 "duplicates: %d (%.1f%%)" % (self.duplicates,
+                                              100 * self.duplicate_rate()),
+                 "rejected: %d" % self.rejected]
+        if self.dead_ends:
+            lines.append("dead ends: %d" % self.dead_ends)
+        ranked = sorted(self.rejects.items(), key=lambda x: -x[1])
+        for (i, count) in ranked:
+            (pat, repl) = filters[i]
+            if repl == 'REJECT':
+                lines.append("  %8d  reject: %s" % (count, pat))
+            else:
+                lines.append("  %8d  filter: %s > %s" % (count, pat, repl))
+        if self.hits:
+            lines.append("filters applied:")
+            ranked = sorted(self.hits.items(), key=lambda x: -x[1])
+            for (i, count) in ranked:
+                (pat, repl) = filters[i]
+                if repl != 'REJECT':
+                    lines.append("  %8d  %s > %s" % (count, pat, repl))
+        if self.times:
+            lines.append("'!' retries: %d" % self.retries)
+            lines.append("time:")
+            total = sum(self.times.values())
+            for stage in PROFILE_STAGES:
+                if stage in self.times:
+                    secs = self.times[stage]
+                    lines.append("  %10.4fs %5.1f%%  %s" %
+                                 (secs, 100 * secs / total if total else 0,
+                                  stage))
+        return "\n".join(lines)
+
+
+# The parts of making a word that a profiling sound system times.
+PROFILE_STAGES = ('select rule', 'run rule', 'assimilation', 'filters',
+                  'sort')
+
+
 def rule2dict(rule):
     items = rule.split()
     d = {}
@@ -119,41 +474,115 @@ def rule2dict(rule):
 
 
 class SoundSystem:
-    def __init__(self):
+    def __init__(self, seed=None, use_numpy=False, profile=False,
+                 constrained=False):
+        """All randomness comes from this sound system's own random
+        number generator, so a seed makes a run repeatable.  With
+        use_numpy (NumPy must be installed) phoneme picks are drawn in
+        vectorized batches.  With profile set, generating words also
+        records timings and filter and retry counts in self.stats.
+        With constrained set, phonemes are drawn so as to avoid the
+        rejections (see constrained)."""
+        self.rng = random.Random(seed)
+        self.nprng = numpy_rng(seed) if use_numpy else None
         self.phonemeset = {}
+        # Every add_ph_unit() call, in order, for reweight().
+        self.ph_units = []
         self.ruleset = {}
+        self.rule_selector = None
+        self.plans = {}
         self.filters = []
+        self.filter_chain = None
         self.randpercent = 10
         self.use_assim = False
         self.use_coronal_metathesis = False
+        self.notation = None
+        # The phoneme features assimilation and metathesis go by; see
+        # use_ipa() and use_digraphs().
+        self.features = sc.FeatureDB(None)
         self.sorter = None
+        self.unknown_letters = 'error'
+        self.stats = GenerationStats()
+        self.profile = profile
+        # How iter_words() remembers the words it has made; see dedup.
+        self.dedup = 'set'
+        self.constrained = constrained
+        # Built when first needed, and thrown away whenever anything
+        # they depend on changes.
+        self.sampler = None
+        self.coder = None
+        self.filter_cache = FilterCache()
 
     def add_ph_unit(self, name, selection):
+        self.ph_units.append((name, selection))
         # add natural weights if there's no weighting.
         if ':' not in selection:
-            selection = natural_weights(selection)
+            selection = natural_weights(selection, self.rng)
             #print('%s = %s' % (name, selection))
-        self.phonemeset[name] = WeightedSelector(rule2dict(selection))
+        self.phonemeset[name] = self.selector(rule2dict(selection))
+        # A new class can change the meaning of any rule.
+        self.plans = {}
+        self.sampler = None
+        self.coder = None
 
     def add_rule(self, rule, weight):
         # add rule verification
         self.ruleset[rule] = weight
+        # Rebuilt on the next call to generate().
+        self.rule_selector = None
+        self.coder = None
+
+    def selector(self, dic):
+        return WeightedSelector(dic, self.rng, self.nprng)
+
+    def seed(self, seed=None):
+        """Restart the random number generator(s) from a seed."""
+        self.rng.seed(seed)
+        if self.nprng is not None:
+            self.nprng = numpy_rng(seed)
+            # Every selector has to pick up the new generator, and
+            # forget what it drew from the old one.
+            for sel in self.phonemeset.values():
+                sel.nprng = self.nprng
+                sel.reset()
+            self.plans = {}
+            self.rule_selector = None
+            self.sampler = None
+            self.coder = None
+
+    def reweight(self, seed=None):
+        """Restart the random number generator(s) from a seed and
+        define every phoneme class over again, drawing new natural
+        weights for those given without weights.  The sound system
+        ends up just as if it had been set up with this seed from the
+        start."""
+        self.seed(seed)
+        units = self.ph_units
+        self.ph_units = []
+        for (name, selection) in units:
+            self.add_ph_unit(name, selection)
+
+    def select_rule(self):
+        if self.rule_selector is None:
+            self.rule_selector = self.selector(self.ruleset)
+        return self.rule_selector.select()
 
     # rules allow phonemes to be in the rule, too: CyVN
-    def run_rule(self, rule):
-        """Generate a single instance of a rule run."""
+    def compile_rule(self, rule):
+        """Turn a word shape into a plan: a list of (opcode, argument)
+        pairs which run_plan() can execute without looking at the
+        rule string again."""
         n = len(rule)
-        s = []
+        plan = []
         for i in range(n):
             # Skip control characters.
             if rule[i] in ['?', '!']: continue
             # Sound that occurs optionally at random.
             if i<(n-1) and rule[i+1] == '?':
-                if random.randint(0, 100) < self.randpercent:
-                    if rule[i] in self.phonemeset: # phoneme class
-                        s.append(self.phonemeset[rule[i]].select())
-                    else: # literal
-                        s.append(rule[i])
+                if rule[i] in self.phonemeset: # phoneme class
+                    plan.append((OPTIONAL, self.phonemeset[rule[i]]))
+                else: # literal
+                    plan.append((OPTIONAL, self.selector({rule[i]: 1})))
             # Sound that must not duplicate the previous sound.
             elif i<(n-1) and i > 0 and rule[i+1] == "!":
                 # First, if the previous class was optional, we need
@@ -163,102 +592,716 @@ class SoundSystem:
                     prevc = rule[i-2]
                 else:
                     prevc = rule[i-1]
-                    #                if (rule[i] != rule[i-1]):
                 # Make sure this is even a duplicate environment.
                 if (rule[i] != prevc):
                     raise RuleError("Misplaced '!' option: in non-duplicate environment: {}.".format(rule))
-                if rule[i] in self.phonemeset:
-                    nph = self.phonemeset[rule[i]].select()
-                    while nph == s[-1]:
-                        nph = self.phonemeset[rule[i]].select()
-                    s.append(nph)
-                else:
+                if rule[i] not in self.phonemeset:
                     raise RuleError("Use of '!' here makes no sense: {}".format(rule))
+                # With only one phoneme to choose from there is no
+                # way to avoid the duplicate.
+                if self.phonemeset[rule[i]].n < 2:
+                    raise RuleError("Use of '!' needs a class with more than one phoneme: {}".format(rule))
+                plan.append((NOREPEAT, self.phonemeset[rule[i]]))
             # Just a normal sound.
             elif rule[i] in self.phonemeset:
-                s.append(self.phonemeset[rule[i]].select())
+                plan.append((CLASS, self.phonemeset[rule[i]]))
             else: # literal
-                s.append(rule[i])
+                plan.append((LITERAL, rule[i]))
+        return plan
+
+    def compile(self):
+        """Compile every word shape and the filters now, so that
+        errors in them turn up before any words are generated."""
+        for rule in self.ruleset:
+            if rule not in self.plans:
+                try:
+                    self.plans[rule] = self.compile_rule(rule)
+                except RuleError as e:
+                    # So that callers can say where the rule came from.
+                    e.rule = rule
+                    raise
+        if self.filter_chain is None:
+            self.filter_chain = FilterChain(self.filters)
+
+    def estimate_space(self):
+        """An upper bound on the number of different words the rules
+        can make.  Filters can only merge or remove words, never add
+        them, so asking for more than this can never succeed."""
+        self.compile()
+        total = 0
+        for plan in self.plans.values():
+            size = 1
+            prev = None
+            for (op, arg) in plan:
+                if op == CLASS:
+                    size *= arg.n
+                elif op == OPTIONAL:
+                    size *= arg.n + 1
+                elif op == NOREPEAT:
+                    # Right after a required draw from the same class
+                    # there's one fewer choice.
+                    if prev == (CLASS, arg):
+                        size *= arg.n - 1
+                    else:
+                        size *= arg.n
+                prev = (op, arg)
+            total += size
+        return total
+
+    def expand_plan(self, plan, prob=1.0):
+        """Yield every (phonemes, probability) that run_plan() could
+        give for this plan, the probability being that of the draws
+        turning out that way."""
+        p_opt = min(max(self.randpercent, 0), 101) / 101.0
+        s = []
+        def expand(i, prob):
+            if i == len(plan):
+                yield (list(s), prob)
+                return
+            (op, arg) = plan[i]
+            if op == LITERAL:
+                s.append(arg)
+                yield from expand(i + 1, prob)
+                s.pop()
+                return
+            if op == OPTIONAL:
+                if p_opt < 1:
+                    yield from expand(i + 1, prob * (1 - p_opt))
+                if p_opt == 0:
+                    return
+                prob *= p_opt
+            total = arg.sum
+            if op == NOREPEAT and s and s[-1] in arg.keys:
+                skip = s[-1]
+                total -= arg.weights[arg.keys.index(skip)]
+            else:
+                skip = None
+            for (key, weight) in zip(arg.keys, arg.weights):
+                if key == skip or weight <= 0:
+                    continue
+                s.append(key)
+                yield from expand(i + 1, prob * weight / total)
+                s.pop()
+        return expand(0, prob)
+
+    def lexicon(self, limit=ENUMERATION_LIMIT):
+        """Every word the phonology can make, found by walking every
+        expansion of every rule rather than by random sampling.
+        Returns a dict of words and the probability of a single
+        attempt at generating a word producing each."""
+        space = self.estimate_space()
+        if limit is not None and space > limit:
+            raise GenerationError("This phonology can make up to %d words, "
+                                  "too many to list them all." % space)
+        rule_total = sum(self.ruleset.values())
+        words = {}
+        for (rule, weight) in self.ruleset.items():
+            plan = self.plans[rule]
+            for (s, prob) in self.expand_plan(plan, weight / rule_total):
+                word = self.apply_filters("".join(s))
+                if word != 'REJECT':
+                    words[word] = words.get(word, 0.0) + prob
+        return words
+
+    def generate_all(self, n=None, unsorted=False, limit=ENUMERATION_LIMIT):
+        """Every word the phonology can make or, given n, a sample of
+        n of them without replacement, weighted by how likely each is
+        to come out of generate()."""
+        words = self.lexicon(limit)
+        if n is None or n >= len(words):
+            words = list(words)
+        else:
+            # Efraimidis and Spirakis: the n largest values of
+            # u**(1/weight) are a weighted sample without replacement.
+            # Their logs, log(u)/weight, keep the same order without
+            # underflowing to 0.0 for unlikely words.  (1 - random()
+            # is never 0.)
+            rand = self.rng.random
+            log = math.log
+            keyed = [(log(1.0 - rand()) / p, w) for (w, p) in words.items()
+                     if p > 0]
+            words = [w for (k, w) in heapq.nlargest(n, keyed,
+                                                   key=lambda kw: kw[0])]
+        if not unsorted:
+            if self.sorter is not None:
+                words = self.sorter(words)
+            else:
+                words.sort()
+        return words
+
+    def run_plan(self, plan, stats=None):
+        """Execute a compiled rule, returning a list of phonemes.
+        Redraws made to avoid a '!' duplicate are counted in stats,
+        if given."""
+        s = []
+        for (op, arg) in plan:
+            if op == LITERAL:
+                s.append(arg)
+            elif op == CLASS:
+                s.append(arg.select())
+            elif op == OPTIONAL:
+                # Same odds as randint(0, 100) < randpercent.
+                if self.rng.random() * 101 < self.randpercent:
+                    s.append(arg.select())
+            else: # NOREPEAT
+                nph = arg.select()
+                if s:
+                    while nph == s[-1]:
+                        nph = arg.select()
+                        if stats is not None:
+                            stats.retries += 1
+                s.append(nph)
+        return s
+
+    def run_rule(self, rule):
+        """Generate a single instance of a rule run."""
+        plan = self.plans.get(rule)
+        if plan is None:
+            plan = self.plans[rule] = self.compile_rule(rule)
+        return "".join(self.run_plan(plan))
+
+    def constrained_sampler(self):
+        if self.sampler is None:
+            self.sampler = ConstrainedSampler(self)
+        return self.sampler
+
+    def phoneme_coder(self):
+        """The PhonemeCoder for this sound system, or None if words
+        have to stay strings."""
+        if self.coder is None:
+            self.coder = False
+            if self.sorter is not None:
+                self.compile()
+                coder = PhonemeCoder(self)
+                if coder.stable:
+                    self.coder = coder
+        return self.coder or None
+
+    def run_constrained(self, rule):
+        """Like run_rule(), but steering clear of the rejections.
+        Returns None if the word ran into a dead end."""
+        s = self.constrained_sampler().run_rule(rule)
+        if s is None:
+            return None
         return "".join(s)
 
+    def profiled_word(self, stats):
+        """select_rule(), run_rule() and apply_filters() in one, with
+        the time spent in each part, the '!' retries and the filters
+        that fired recorded in stats.  None for a constrained dead
+        end."""
+        times = stats.times
+        clock = time.perf_counter
+        t0 = clock()
+        rule = self.select_rule()
+        t1 = clock()
+        if self.constrained:
+            word = self.constrained_sampler().run_rule(rule)
+        else:
+            plan = self.plans.get(rule)
+            if plan is None:
+                plan = self.plans[rule] = self.compile_rule(rule)
+            word = self.run_plan(plan, stats)
+        t2 = clock()
+        if word is None:
+            times['run rule'] = times.get('run rule', 0.0) + t2 - t1
+            return None
+        word = "".join(word)
+        if self.sorter:
+            w = self.sorter.split(word)
+            if self.use_assim:
+                w = self.features.apply_assimilations(w)
+            if self.use_coronal_metathesis:
+                w = self.features.apply_coronal_metathesis(w)
+            word = "".join(w)
+        t3 = clock()
+        if self.constrained:
+            chain = self.constrained_sampler().chain
+        else:
+            chain = self.filter_chain
+        word = chain.apply_counted(word, stats.hits)
+        t4 = clock()
+        for (stage, secs) in (('select rule', t1 - t0), ('run rule', t2 - t1),
+                              ('assimilation', t3 - t2), ('filters', t4 - t3)):
+            times[stage] = times.get(stage, 0.0) + secs
+        return word
+
     def add_filter(self, pat, repl):
         if repl == '!':
             self.filters.append((pat, ""))
         else:
-            self.filters.append((pat, repl))    
+            self.filters.append((pat, repl))
+        self.filter_chain = None
+        self.sampler = None
+        self.filter_cache.clear()
+
+    def apply_filters(self, word, chain=None):
+        """Assimilation and metathesis, if in use, then the filters
+        (or the given FilterChain, made from them, which must give the
+        same result for this word).  Results are kept in
+        self.filter_cache."""
+        if chain is None:
+            if self.filter_chain is None:
+                self.filter_chain = FilterChain(self.filters)
+            chain = self.filter_chain
+        found = self.filter_cache.get(word)
+        if found is not None:
+            (result, rejected_by, key) = found
+            if result == 'REJECT':
+                chain.rejected_by = rejected_by
+            return result
+        raw = word
 
-    def apply_filters(self, word):
         # First, if assimilations and metathesis are in play, apply those.
         if self.sorter:
             w = self.sorter.split(word)
             if self.use_assim:
-                w = sc.apply_assimilations(w)
+                w = self.features.apply_assimilations(w)
             if self.use_coronal_metathesis:
-                w = sc.apply_coronal_metathesis(w)
+                w = self.features.apply_coronal_metathesis(w)
             word = "".join(w)
 
         # Now the filters.
-        for (pat, repl) in self.filters:
-            word = re.sub(pat, repl, word)
-            if re.search('REJECT', word, flags=re.UNICODE):
-                return 'REJECT'
+        word = chain.apply(word)
+        rejected_by = chain.rejected_by if word == 'REJECT' else None
+        self.filter_cache.put(raw, (word, rejected_by, None))
         return word
 
     def add_sort_order(self, order):
-        self.sorter = ArbSorter(order)
+        self.sorter = ArbSorter(order, self.unknown_letters)
+        self.sampler = None
+        self.coder = None
+        self.filter_cache.clear()
 
     def use_ipa(self):
-        sc.initialize()
+        self.notation = 'ipa'
+        self.features = sc.FeatureDB('ipa')
+        self.sampler = None
+        self.coder = None
+        self.filter_cache.clear()
 
     def use_digraphs(self):
-        sc.initialize('digraph')
+        self.notation = 'digraph'
+        self.features = sc.FeatureDB('digraph')
+        self.sampler = None
+        self.coder = None
+        self.filter_cache.clear()
 
     def with_std_assimilations(self):
         self.use_assim = True
+        self.sampler = None
+        self.coder = None
+        self.filter_cache.clear()
 
     def with_coronal_metathesis(self):
         self.use_coronal_metathesis = True
+        self.sampler = None
+        self.coder = None
+        self.filter_cache.clear()
+
+    def iter_words(self, n=None, unique=True, patience=PATIENCE,
+                   max_attempts=None, partial=False, exclude=()):
+        """Yield words one at a time as they are made, n of them or,
+        if n is None, for as long as the caller keeps asking.  Unless
+        unique is false, no word is yielded twice, nor any word in
+        exclude.
 
-    def generate(self, n=10, unsorted=False):
-        """Generate n unique words randomly from the rules."""
-        words = set()
-        while len(words) < n:
-            rule = select(self.ruleset)
-            word = self.apply_filters(self.run_rule(rule))
-            if word != 'REJECT':
-                words.add(word)
-        words = list(words)
+        Gives up after patience candidates in a row fail to produce a
+        new word, or after max_attempts candidates altogether (either
+        can be None for no limit).  Giving up raises GenerationError,
+        or, with partial set, just ends the words early.  Counts are
+        kept in self.stats.
+
+        The words already made are kept in the kind of container named
+        by self.dedup, which can trade speed for memory on very long
+        runs.  If self.constrained is set the words are drawn so as to
+        avoid the rejections, and a draw that gets stuck counts as a
+        failure."""
+        for (word, key) in self.iter_keyed(n, unique, patience,
+                                           max_attempts, partial, exclude):
+            yield word
+
+    def iter_keyed(self, n=None, unique=True, patience=PATIENCE,
+                   max_attempts=None, partial=False, exclude=()):
+        """iter_words(), but yielding (word, key) pairs, where key is
+        the word's sort key if it came for free (see PhonemeCoder),
+        and otherwise None."""
+        self.compile()
+        if n is not None and unique and not partial:
+            self.check_space(n)
+        stats = self.stats = GenerationStats()
+        chain = self.filter_chain
+        if self.constrained:
+            chain = self.constrained_sampler().chain
+        coder = None
+        if not (self.profile or self.constrained):
+            coder = self.phoneme_coder()
+        seen = new_seen(self.dedup, n)
+        count = 0
+        failures = 0
+        while n is None or count < n:
+            if patience is not None and failures >= patience:
+                msg = ("No new words in the last %d attempts; "
+                       "the phonology seems to be exhausted" % failures)
+            elif max_attempts is not None and stats.attempts >= max_attempts:
+                msg = "Gave up after %d attempts" % stats.attempts
+            else:
+                msg = None
+            if msg is not None:
+                if partial:
+                    return
+                raise GenerationError("%s (%d words made)." % (msg, count))
+            stats.attempts += 1
+            key = None
+            if coder is not None:
+                (word, key) = coder.make_word(self.select_rule(), chain)
+            elif self.profile:
+                word = self.profiled_word(stats)
+            elif self.constrained:
+                word = self.run_constrained(self.select_rule())
+                if word is not None:
+                    word = self.apply_filters(word, chain)
+            else:
+                word = self.apply_filters(self.run_rule(self.select_rule()))
+            if word is None:
+                stats.dead_ends += 1
+                failures += 1
+                continue
+            if word == 'REJECT':
+                stats.rejected += 1
+                i = chain.rejected_by
+                stats.rejects[i] = stats.rejects.get(i, 0) + 1
+                failures += 1
+                continue
+            if unique:
+                if word in seen or word in exclude:
+                    stats.duplicates += 1
+                    failures += 1
+                    continue
+                seen.add(word)
+            failures = 0
+            count += 1
+            stats.words = count
+            yield (word, key)
+
+    def check_space(self, n):
+        space = self.estimate_space()
+        if n > space:
+            raise GenerationError("Asked for %d words, but the rules can "
+                                  "make at most %d." % (n, space))
+
+    def generate(self, n=10, unsorted=False, workers=1, seed=None,
+                 partial=False):
+        """Generate n unique words randomly from the rules.  With more
+        than one worker the words are made in that many processes; a
+        given seed and number of workers always give the same words.
+
+        If the rules can't make n different words GenerationError is
+        raised, unless partial is set, in which case you get as many
+        as could be found."""
+        if workers > 1:
+            words = self.generate_parallel(n, workers, seed, partial)
+        else:
+            if seed is not None:
+                self.seed(seed)
+            pairs = list(self.iter_keyed(n, partial=partial))
+            if not unsorted:
+                return self.sort_keyed(pairs)
+            words = [word for (word, k) in pairs]
         if not unsorted:
+            start = time.perf_counter()
             if self.sorter is not None:
                 words = self.sorter(words)
             else:
                 words.sort()
+            if self.profile:
+                self.stats.times['sort'] = time.perf_counter() - start
         return words
 
+    def sort_keyed(self, pairs):
+        """The words of the (word, key) pairs from iter_keyed(), in
+        the order generate() puts them."""
+        start = time.perf_counter()
+        if self.sorter is not None:
+            # Use the keys that came with the words.  Like sorted(),
+            # list.sort() is stable, so the order is just what
+            # self.sorter(words) gives.
+            key = self.sorter.key
+            pairs.sort(key=lambda p: key(p[0]) if p[1] is None else p[1])
+            words = [word for (word, k) in pairs]
+        else:
+            words = sorted([word for (word, k) in pairs])
+        if self.profile:
+            self.stats.times['sort'] = time.perf_counter() - start
+        return words
 
-def textify(phsys, sentences=11):
-    """Generate a fake paragraph of text from a sound system."""
-    text = ""
-    for i in range(sentences):
-        sent = random.randint(3, 11)
+    async def aiter_words(self, n=None, unique=True, **kwargs):
+        """iter_words() for asyncio programs, as an async generator.
+        Words are only made as they are asked for, and the event loop
+        gets a turn every ASYNC_SLICE seconds or so; cancelling the
+        task, or closing the generator, stops generation there.  Only
+        one generation at a time per sound system."""
+        async for word in cooperate(self.iter_words(n, unique, **kwargs)):
+            yield word
+
+    async def agenerate(self, n=10, unsorted=False, seed=None,
+                        partial=False):
+        """generate() for asyncio programs: the same words as
+        generate() with one worker, made a slice of time at a time as
+        in aiter_words().  The sort, which takes a while for a long
+        list, runs in the event loop's default executor."""
+        if seed is not None:
+            self.seed(seed)
+        pairs = [pair async for pair in
+                 cooperate(self.iter_keyed(n, partial=partial))]
+        if unsorted:
+            return [word for (word, k) in pairs]
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.sort_keyed, pairs)
+
+    def sort_key(self):
+        """The key function for the order generate() sorts words into,
+        giving bytes."""
+        if self.sorter is not None:
+            return self.sorter.key
+        # UTF-8 sorts in the same order as the code points.
+        return str.encode
+
+    def iter_sorted(self, words, run_size=RUN_SIZE, tmpdir=None):
+        """Yield words (any iterable) in the order generate() sorts
+        them into, holding at most run_size of them in memory at a
+        time and keeping the rest in temporary files."""
+        return external_sort(words, self.sort_key(), run_size, tmpdir)
+
+    def load_words(self, words):
+        """Put words (any iterable, such as read_words() of an existing
+        word list) in a container of the kind self.dedup names, to be
+        handed to iter_words() as exclude.  Returns the container and
+        whether the words were in sorted order."""
+        seen = new_seen(self.dedup)
+        key = self.sort_key()
+        ordered = True
+        prev = None
+        for word in words:
+            seen.add(word)
+            if ordered:
+                k = key(word)
+                if prev is not None and k < prev:
+                    ordered = False
+                prev = k
+        return (seen, ordered)
+
+    def merge_sorted(self, old, new, old_sorted=True):
+        """Yield the words of old and new (iterables, new already
+        sorted) together in sorted order.  If old isn't sorted it is
+        sorted on the way, on disk if need be."""
+        if old_sorted:
+            return heapq.merge(old, new, key=self.sort_key())
+        return self.iter_sorted(itertools.chain(old, new))
+
+    def generate_parallel(self, n, workers, seed=None, partial=False):
+        """Split the work of generate() into shards, one per worker
+        process.  Each shard has its own seed, derived from the main
+        one, and the results are merged in shard order, so the outcome
+        doesn't depend on which process finishes first.  If duplicates
+        across shards leave us short, another round of shards is run,
+        told which words we have found since the last one."""
+        self.compile()
+        if not partial:
+            self.check_space(n)
+        if seed is None:
+            seed = self.rng.randrange(2**32)
+        stats = self.stats = GenerationStats()
+        words = []
+        seen = new_seen(self.dedup, n)
+        rnd = 0
+        sent = 0       # how many of words the workers have been sent
+        barrier = multiprocessing.Barrier(workers)
+        with multiprocessing.Pool(workers, init_worker,
+                                  (self, n, barrier)) as pool:
+            while len(words) < n:
+                per_shard = -(-(n - len(words)) // workers)
+                new = words[sent:]
+                sent = len(words)
+                jobs = [(shard_seed(seed, rnd, i), per_shard, new)
+                        for i in range(workers)]
+                before = len(words)
+                shards = pool.map(generate_shard, jobs, chunksize=1)
+                for (shard, shard_stats) in shards:
+                    stats.merge(shard_stats)
+                    for word in shard:
+                        if word not in seen:
+                            seen.add(word)
+                            words.append(word)
+                        else:
+                            stats.duplicates += 1
+                # The shards give up when they stop finding words we
+                # don't have, so a round with nothing new means we're
+                # done.
+                if len(words) == before:
+                    if partial:
+                        break
+                    raise GenerationError("The phonology seems to be "
+                                          "exhausted (%d words made)."
+                                          % len(words))
+                rnd += 1
+        stats.words = min(len(words), n)
+        return words[:n]
+
+
+def read_words(fname):
+    """Yield the words in a word list file, one at a time.  Any layout
+    will do, one word per line or several."""
+    with open(fname, encoding='utf-8') as f:
+        for line in f:
+            yield from line.split()
+
+
+# Seeds for generate_parallel()'s shards.  These have to be the same
+# from run to run (so no hash()), and integers, for NumPy's sake.
+def shard_seed(seed, rnd, i):
+    return random.Random("%s:%d:%d" % (seed, rnd, i)).getrandbits(63)
+
+
+# The worker side of SoundSystem.generate_parallel().  Each process
+# is handed the sound system once, when the pool starts up, and then
+# only receives (seed, count, new words to avoid) triples, adding the
+# new words to the ones it already avoids.  For that every process
+# has to see every round's words, so each waits at the barrier until
+# all the others have a job too: no process can take two jobs in a
+# round, which leaves exactly one for each.
+worker_soundsys = None
+worker_exclude = None
+worker_barrier = None
+
+def init_worker(soundsys, n, barrier):
+    global worker_soundsys, worker_exclude, worker_barrier
+    worker_soundsys = soundsys
+    worker_exclude = new_seen(soundsys.dedup, n)
+    worker_barrier = barrier
+
+def generate_shard(job):
+    (seed, n, new) = job
+    for word in new:
+        worker_exclude.add(word)
+    worker_barrier.wait()
+    worker_soundsys.seed(seed)
+    words = list(worker_soundsys.iter_words(n, partial=True,
+                                            exclude=worker_exclude))
+    return (words, worker_soundsys.stats)
+
+
+def iter_sentences(phsys, sentences=None, words=None):
+    """Yield sentences of fake text from a sound system, that many of
+    them or, if sentences is None, forever.  The words come from
+    words, an iterator, if given; otherwise they are drawn from the
+    sound system, repeats allowed, through a single run of
+    iter_words()."""
+    rng = phsys.rng
+    if words is None:
+        words = phsys.iter_words(unique=False)
+    i = 0
+    while sentences is None or i < sentences:
+        sent = rng.randint(3, 11)
         if sent >= 7:
-            comma = random.randint(0, sent - 2)
+            comma = rng.randint(0, sent - 2)
         else:
             comma = -1
-        text += phsys.generate(1, unsorted=True)[0].capitalize()
+        parts = [next(words).capitalize()]
         for j in range(sent):
-            text += " " + phsys.generate(1, unsorted=True)[0]
+            word = next(words)
             if j == comma:
-                text += ","
-        if random.randint(0, 100) <= 85:
-            text += ". "
+                word += ","
+            parts.append(word)
+        if rng.randint(0, 100) <= 85:
+            parts[-1] += "."
         else:
-            text += "? "
-    text = textwrap.wrap(text, 70)
-    return "\n".join(text)
+            parts[-1] += "?"
+        yield " ".join(parts)
+        i += 1
+
+
+def zipf_words(phsys, k, exponent=ZIPF_EXPONENT, partial=False):
+    """An endless stream of words drawn from a lexicon of k words made
+    by the sound system, with Zipfian frequencies.  Shorter words get
+    the higher ranks, as in real languages; the alias table behind
+    the draws makes each one take constant time."""
+    lexicon = sorted(phsys.generate(k, unsorted=True, partial=partial),
+                     key=len)
+    if not lexicon:
+        raise GenerationError("The phonology made no words at all.")
+    sel = phsys.selector(dict([(w, 1.0 / (r + 1) ** exponent)
+                               for (r, w) in enumerate(lexicon)]))
+    return iter(sel.select, None)
+
+
+def wrap_lines(pieces, width=70):
+    """Yield the lines textwrap.wrap() would make of the pieces of text
+    joined by spaces, without ever holding more than a few lines of
+    them.  Every line but the last of a wrapped stretch of text is
+    final; the last is carried over into the next stretch."""
+    wrapper = textwrap.TextWrapper(width)
+    pending = []
+    size = 0
+    for piece in pieces:
+        pending.append(piece)
+        size += len(piece) + 1
+        if size > 4 * width:
+            lines = wrapper.wrap(" ".join(pending))
+            for line in lines[:-1]:
+                yield line
+            pending = lines[-1:]
+            size = sum([len(line) for line in pending])
+    yield from wrapper.wrap(" ".join(pending))
+
+
+async def cooperate(iterable, timeslice=ASYNC_SLICE):
+    """Yield the items of a slow iterator to an asyncio program,
+    giving the event loop a turn whenever timeslice seconds have gone
+    by since the last one.  The iterator is closed when the generator
+    is, or when the task running it is cancelled."""
+    items = iter(iterable)
+    try:
+        deadline = time.perf_counter() + timeslice
+        for item in items:
+            yield item
+            if time.perf_counter() >= deadline:
+                await asyncio.sleep(0)
+                deadline = time.perf_counter() + timeslice
+    finally:
+        if hasattr(items, 'close'):
+            items.close()
+
+
+def iter_text(phsys, sentences=None, width=70, words=None):
+    """A paragraph of fake text, as a stream of lines at most width
+    long.  See iter_sentences() for words."""
+    return wrap_lines(iter_sentences(phsys, sentences, words), width)
+
+
+def textify(phsys, sentences=11):
+    """Generate a fake paragraph of text from a sound system."""
+    return "\n".join(iter_text(phsys, sentences))
 
 
 if __name__ == '__main__':
+    # A weighted sample from generate_all() has to follow the word
+    # probabilities, even when those are tiny.
+    m2 = SoundSystem(1)
+    m2.add_ph_unit('C', 'p t k s m n l r h w y b d g f')
+    m2.add_ph_unit('V', 'a i u e o')
+    m2.add_rule('CVCVCV', 1)
+    lexicon = m2.lexicon()
+    expected = {}
+    for (w, p) in lexicon.items():
+        expected[w[0]] = expected.get(w[0], 0.0) + p
+    sample = m2.generate_all(5000, unsorted=True)
+    for c in expected:
+        got = sum([1 for w in sample if w[0] == c]) / len(sample)
+        assert abs(got - expected[c]) < 0.03, (c, got, expected[c])
+    print("generate_all(): %d of %d words, first letters as expected" %
+          (len(sample), len(lexicon)))
+
     m1 = SoundSystem()
     m1.add_ph_unit('V', 'a i á u o')
     m1.add_ph_unit('C', 't n k l h ch m s ɬ p š')